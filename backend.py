@@ -1,20 +1,179 @@
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, jsonify, request, g, has_request_context, json, stream_with_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_marshmallow import Marshmallow
-from sqlalchemy import or_
-from marshmallow import post_dump
+from sqlalchemy import or_, and_
 from marshmallow_sqlalchemy import TableSchema
-from sqlalchemy import exc, desc
-from datetime import datetime
+from sqlalchemy import exc, desc, inspect, case, cast, func, select, create_engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import Load, aliased, joinedload, selectinload, contains_eager, sessionmaker
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy import text, event
+from sqlalchemy.engine import Engine
+import base64
+import click
+import bisect
+import functools
+import hashlib
+import itertools
+import math
 import os
+import re
+import sys
+import threading
+import time
+import unicodedata
 
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 # app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite3'
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Per process. Pre-ping and recycle drop connections the server or a proxy closed
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size' : int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow' : int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout' : int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle' : int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping' : os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+        # Milliseconds; 0 disables it
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
+            'options' : f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))}"}
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 50))
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 200))
+# Rows fetched, serialized and sent per chunk by ?stream= listings
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+# 'postgres' or 'memory' (single process only); defaults to the one matching the database
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND')
+# 'memory' or 'redis'
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+# Share one in-flight response between concurrent identical GETs on @coalesced routes
+app.config['COALESCE_REQUESTS'] = os.environ.get('COALESCE_REQUESTS', '1') == '1'
+# Token bucket per client: sustained requests per second and burst size; unset disables it
+app.config['RATE_LIMIT_PER_SECOND'] = float(os.environ['RATE_LIMIT_PER_SECOND']) if os.environ.get('RATE_LIMIT_PER_SECOND') else None
+app.config['RATE_LIMIT_BURST'] = int(os.environ.get('RATE_LIMIT_BURST', 60))
+# 'memory' or 'redis'; redis shares the buckets between workers
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_REDIS_URL'] = os.environ.get('RATE_LIMIT_REDIS_URL', app.config['CACHE_REDIS_URL'])
+# Proxies in front of the app that append to X-Forwarded-For (1 for Heroku's router); 0 uses the socket address
+app.config['RATE_LIMIT_TRUSTED_PROXIES'] = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 1))
+app.config['REFERENCE_CHECK_SECONDS'] = int(os.environ.get('REFERENCE_CHECK_SECONDS', 60))
+# Log requests slower than this many milliseconds with their SQL; unset disables it
+app.config['SLOW_REQUEST_MS'] = int(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None
+# Background job threads per process; 0 leaves the outbox to `flask run_jobs --watch`
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+# First retry delay, doubled on every further attempt
+app.config['JOB_RETRY_SECONDS'] = int(os.environ.get('JOB_RETRY_SECONDS', 5))
+# A running job older than this is assumed lost with its worker and run again
+app.config['JOB_TIMEOUT_SECONDS'] = int(os.environ.get('JOB_TIMEOUT_SECONDS', 300))
+# Comma-separated replicas of DATABASE_URL for @read_only routes; empty reads from the primary
+app.config['DATABASE_REPLICA_URLS'] = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+# How long a replica that failed to connect is skipped
+app.config['REPLICA_RETRY_SECONDS'] = int(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+# How long a client reads from the primary after its last write; should exceed the replication lag
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
 
-db = SQLAlchemy(app)
+# Read replicas
+# Routes marked @read_only run their queries on one replica per request,
+# picked round robin. Anything else, any flush, and any client that wrote
+# within REPLICA_STICKY_SECONDS (tracked with a cookie) stays on the primary.
+# A replica that cannot be reached is skipped for REPLICA_RETRY_SECONDS and
+# the request falls back to the next one, then to the primary.
+
+class ReplicaRouter:
+    COOKIE = 'usell_primary_until'
+
+    def __init__(self):
+        self.engines = None
+        self.down_until = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def get_engines(self):
+        with self.lock:
+            if self.engines == None:
+                options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+                self.engines = [create_engine(url, **options) for url in app.config['DATABASE_REPLICA_URLS']]
+        return self.engines
+
+    def connect(self):
+        engines = self.get_engines()
+        start = next(self.counter)
+        for offset in range(len(engines)):
+            index = (start + offset) % len(engines)
+            if self.down_until.get(index, 0) > time.monotonic():
+                continue
+            try:
+                return engines[index].connect()
+            except exc.DBAPIError as e:
+                self.down_until[index] = time.monotonic() + app.config['REPLICA_RETRY_SECONDS']
+                app.logger.warning(f'Replica {engines[index].url!r} unavailable, skipping it: {e}')
+        return None
+
+    def pinned_to_primary(self):
+        try:
+            return g.get('wrote', False) or float(request.cookies.get(self.COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def connection(self):
+        # The replica connection of the current request, or None for the primary
+        if not (app.config['DATABASE_REPLICA_URLS'] and has_request_context() and g.get('read_only')):
+            return None
+        if 'replica' not in g:
+            g.replica = None if self.pinned_to_primary() else self.connect()
+        return g.replica
+
+replicas = ReplicaRouter()
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            connection = replicas.connection()
+            if connection != None:
+                return connection
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+def read_only(view):
+    @functools.wraps(view)
+    def read_only_view(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return read_only_view
+
+db = RoutingSQLAlchemy(app)
+
+@event.listens_for(db.session, 'after_commit')
+def pin_to_primary(session):
+    if has_request_context():
+        g.wrote = True
+
+@app.after_request
+def set_primary_cookie(response):
+    if g.get('wrote') and app.config['DATABASE_REPLICA_URLS']:
+        sticky = app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(ReplicaRouter.COOKIE, str(time.time() + sticky), max_age=sticky, httponly=True)
+    return response
+
+@app.teardown_appcontext
+def release_replica(exception):
+    connection = g.pop('replica', None)
+    if connection != None:
+        # The session only borrowed the connection; end its transaction first
+        db.session.remove()
+        connection.close()
 ma = Marshmallow(app)
 
 # SQLAlchemy Models
@@ -28,6 +187,13 @@ class Student(db.Model):
     profile_image_url = db.Column(db.String(500))
     seller_rating = db.Column(db.Float, default=0.0)
     purchaser_rating = db.Column(db.Float, default=0.0)
+    # Running aggregates behind the ratings, see backfill_ratings
+    seller_rating_sum = db.Column(db.Float, nullable=False, default=0.0, server_default=db.text('0'))
+    seller_rating_count = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    purchaser_rating_sum = db.Column(db.Float, nullable=False, default=0.0, server_default=db.text('0'))
+    purchaser_rating_count = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    # Bumped by writes that change how the student is serialized, see Version stamps
+    version = db.Column(db.Integer, nullable=False, default=1, server_default=db.text('1'))
     career_id = db.Column(db.Integer, db.ForeignKey('career.id'), nullable=False)
     career = db.relationship('Career', backref='student')
 
@@ -44,9 +210,13 @@ class Category(db.Model):
 # Mid relation
 careers = db.Table('careers',
     db.Column('career_id', db.Integer, db.ForeignKey('career.id'), primary_key=True),
-    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Index('ix_careers_post_id', 'post_id')
 )
 
+# Predicate of the partial indexes backing the active post listings
+active_post = text("status = 'active'")
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
@@ -56,6 +226,8 @@ class Post(db.Model):
     status = db.Column(db.String(50), default='active')
     level = db.Column(db.Integer, nullable=False)
     publish_date = db.Column(db.DateTime, default=datetime.now())
+    # Bumped by writes that change how the post is serialized, see Version stamps
+    version = db.Column(db.Integer, nullable=False, default=1, server_default=db.text('1'))
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     category = db.relationship('Category', backref='post')
@@ -65,6 +237,13 @@ class Post(db.Model):
 
     careers = db.relationship('Career', secondary=careers, backref='post')
 
+    __table_args__ = (
+        db.Index('ix_post_active_id', 'id', postgresql_where=active_post, sqlite_where=active_post),
+        db.Index('ix_post_active_category_id_id', 'category_id', 'id', postgresql_where=active_post, sqlite_where=active_post),
+        db.Index('ix_post_active_level_id', 'level', 'id', postgresql_where=active_post, sqlite_where=active_post),
+        db.Index('ix_post_student_id_status', 'student_id', 'status'),
+    )
+
 class WishPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     added_date = db.Column(db.DateTime, default=datetime.now())
@@ -73,6 +252,11 @@ class WishPost(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     student = db.relationship('Student', backref='wishPost')
 
+    __table_args__ = (
+        db.Index('ix_wish_post_student_id_post_id', 'student_id', 'post_id'),
+        db.Index('ix_wish_post_post_id', 'post_id'),
+    )
+
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, default=datetime.now())
@@ -84,15 +268,76 @@ class Transaction(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     student = db.relationship('Student', backref='transaction')
 
+    __table_args__ = (
+        db.Index('ix_transaction_post_id_purchaser_status', 'post_id', 'purchaser_status'),
+        db.Index('ix_transaction_student_id_seller_status', 'student_id', 'seller_status'),
+    )
+
+class SuggestionFeed(db.Model):
+    # Materialized feed behind /sugested_posts: one row per active post and
+    # career it targets. Rebuilt per post by the refresh_suggestions job.
+    career_id = db.Column(db.Integer, db.ForeignKey('career.id'), primary_key=True)
+    level = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    student_id = db.Column(db.Integer, nullable=False)
+    wish_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_suggestion_feed_popular', 'career_id', 'level', 'wish_count', 'post_id'),
+        db.Index('ix_suggestion_feed_post_id', 'post_id'),
+    )
+
+class PostCard(db.Model):
+    # Read model behind ?view=card: what a listing card shows, one row per
+    # post, so card listings scan a single table. Rebuilt per post by the
+    # refresh_post_cards job; see also rebuild_post_cards and check_post_cards.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(50), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    image_url = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.String(50))
+    level = db.Column(db.Integer, nullable=False)
+    publish_date = db.Column(db.DateTime)
+    category_id = db.Column(db.Integer, nullable=False)
+    category_name = db.Column(db.String(50), nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)
+    seller_name = db.Column(db.String(50), nullable=False)
+    seller_rating = db.Column(db.Float)
+    # Comma-separated, in no particular order
+    career_ids = db.Column(db.String(200), nullable=False, default='')
+    # Versions of the post and seller the card was built from, see recent_posts_stamp
+    post_version = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    seller_version = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+
+    __table_args__ = (
+        db.Index('ix_post_card_active_id', 'id', postgresql_where=active_post, sqlite_where=active_post),
+        db.Index('ix_post_card_active_category_id_id', 'category_id', 'id', postgresql_where=active_post, sqlite_where=active_post),
+        db.Index('ix_post_card_student_id_status', 'student_id', 'status'),
+    )
+
+class Job(db.Model):
+    # Outbox of side effects. A write inserts its jobs in its own transaction,
+    # so they are durable exactly when the write is; handled jobs are deleted
+    # and jobs that ran out of attempts stay behind as 'failed'.
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
 # Marshmallow Models
 
 class CategorySchema(ma.ModelSchema):
     class Meta:
         model = Category
-    @post_dump
-    def exclude_fields(self, data, **kwargs):
-        data.pop('post')
-        return data
+        exclude = ('post',)
 
 class CarrerSchema(ma.ModelSchema):
     class Meta:
@@ -101,39 +346,24 @@ class CarrerSchema(ma.ModelSchema):
 class StudentSchema(ma.ModelSchema):
     class Meta:
         model = Student
-    career = ma.Nested(CarrerSchema)
-    @post_dump
-    def exclude_carrer(self, data, **kwargs):
-        data['career'].pop('post')
-        data['career'].pop('student')
-        data.pop('post')
-        data.pop('transaction')
-        data.pop('wishPost')
-        return data
+        exclude = ('post', 'transaction', 'wishPost', 'seller_rating_sum', 'seller_rating_count', 'purchaser_rating_sum', 'purchaser_rating_count', 'version')
+    career = ma.Nested(CarrerSchema, exclude=('post', 'student'))
 
 class WishPostHelperSchema(ma.ModelSchema):
     class Meta:
         model = WishPost
-    @post_dump
-    def exclude_fields(self, data, **kwargs):
-        data.pop('added_date')
-        data.pop('post')
-        return data
+        exclude = ('added_date', 'post')
+    # Read the foreign key column instead of loading the related Student
+    student = ma.Int(attribute='student_id')
 
 class PostSchema(ma.ModelSchema):
     class Meta:
         model = Post
-    careers = ma.Nested(CarrerSchema, many=True)
+        exclude = ('transaction', 'version')
+    careers = ma.Nested(CarrerSchema, many=True, exclude=('post', 'student'))
     wishPost = ma.Nested(WishPostHelperSchema, many=True)
     category = ma.Nested(CategorySchema)
     student = ma.Nested(StudentSchema)
-    @post_dump
-    def exclude_fields(self, data, **kwargs):
-        for career in data['careers']:
-            career.pop('post')
-            career.pop('student')
-        data.pop('transaction')
-        return data
 
 class WishPostSchema(ma.ModelSchema):
     class Meta:
@@ -164,22 +394,1353 @@ posts_schema = PostSchema(many=True)
 wish_posts_schema = WishPostSchema(many=True)
 transactions_schema = TransactionSchema(many=True)
 
+# Fast serializers
+# Hand-written equivalents of the schemas above, used by the endpoints. They
+# read only the attributes that end up in the response and produce exactly
+# the same JSON as the schema dumps (see benchmarks/serialization.py).
+
+def dump_datetime(value):
+    return value.isoformat() if value != None else None
+
+def dump_float(value):
+    return float(value) if value != None else None
+
+def serialize_career(career):
+    return {'career_name' : career.career_name, 'id' : career.id}
+
+def serialize_career_members(career):
+    return {
+        'career_name' : career.career_name,
+        'id' : career.id,
+        'post' : [post.id for post in career.post],
+        'student' : [student.id for student in career.student],
+    }
+
+def serialize_category(category):
+    return {
+        'description' : category.description,
+        'id' : category.id,
+        'image_url' : category.image_url,
+        'name' : category.name,
+    }
+
+def serialize_student(student):
+    return {
+        'career' : serialize_career(student.career),
+        'email' : student.email,
+        'id' : student.id,
+        'level' : student.level,
+        'name' : student.name,
+        'phone_number' : student.phone_number,
+        'profile_image_url' : student.profile_image_url,
+        'purchaser_rating' : dump_float(student.purchaser_rating),
+        'seller_rating' : dump_float(student.seller_rating),
+    }
+
+def serialize_post(post, compact=False):
+    data = {
+        'careers' : [serialize_career(career) for career in post.careers],
+        'category' : serialize_category(post.category),
+        'description' : post.description,
+        'id' : post.id,
+        'image_url' : post.image_url,
+        'level' : post.level,
+        'name' : post.name,
+        'price' : dump_float(post.price),
+        'publish_date' : dump_datetime(post.publish_date),
+        'status' : post.status,
+        'student' : serialize_student(post.student),
+    }
+    if not compact:
+        data['wishPost'] = [{'id' : wish_post.id, 'student' : wish_post.student_id} for wish_post in post.wishPost]
+    return data
+
+def serialize_wish_post(wish_post, compact=False):
+    return {
+        'added_date' : dump_datetime(wish_post.added_date),
+        'id' : wish_post.id,
+        'post' : serialize_post(wish_post.post, compact),
+        'student' : serialize_student(wish_post.student),
+    }
+
+def serialize_transaction(transaction, compact=False):
+    return {
+        'date' : dump_datetime(transaction.date),
+        'general_status' : transaction.general_status,
+        'id' : transaction.id,
+        'post' : serialize_post(transaction.post, compact),
+        'purchaser_status' : transaction.purchaser_status,
+        'seller_status' : transaction.seller_status,
+        'student' : serialize_student(transaction.student),
+    }
+
+def serialize_one(serialize, item):
+    start = time.perf_counter()
+    data = serialize(item)
+    record_serialization(time.perf_counter() - start)
+    return data
+
+def serialize_many(serialize, items):
+    start = time.perf_counter()
+    data = [serialize(item) for item in items]
+    record_serialization(time.perf_counter() - start)
+    return data
+
+# Eager loading options
+# Each helper mirrors the nesting of its schema so a dump never triggers lazy loads.
+# ``base`` is the loader that reaches the model, e.g. joinedload(WishPost.post).
+
+def student_options(base=None):
+    base = Load(Student) if base is None else base
+    return [base.joinedload(Student.career)]
+
+def post_options(base=None, wishes=True):
+    base = Load(Post) if base is None else base
+    options = [
+        base.joinedload(Post.category),
+        base.joinedload(Post.student).joinedload(Student.career),
+        base.selectinload(Post.careers),
+    ]
+    if wishes:
+        options.append(base.selectinload(Post.wishPost))
+    return options
+
+def career_options():
+    return [
+        selectinload(Career.post).load_only('id'),
+        selectinload(Career.student).load_only('id'),
+    ]
+
+def student_query():
+    return Student.query.options(*student_options())
+
+def post_query(wishes=True):
+    return Post.query.options(*post_options(wishes=wishes))
+
+def wish_post_query(wishes=True):
+    # Callers join Post explicitly, so reuse that join for the nested post
+    return WishPost.query.join(Post).options(
+        *post_options(contains_eager(WishPost.post), wishes),
+        *student_options(joinedload(WishPost.student)))
+
+def transaction_query(wishes=True):
+    return Transaction.query.join(Post).options(
+        *post_options(contains_eager(Transaction.post), wishes),
+        *student_options(joinedload(Transaction.student)))
+
+# Wishlist state
+# Listings tag every post with ``is_wished`` for the requesting student and
+# ``wish_count``, the wishes of everyone else, from one grouped query per page.
+# ?compact=1 also drops the wishPost arrays and the query that loads them.
+
+def compact_listing():
+    return request.args.get('compact') in ('1', 'true')
+
+def wish_states(post_ids, student_id):
+    wished = func.sum(case([(WishPost.student_id == student_id, 1)], else_=0))
+    rows = db.session.query(WishPost.post_id, func.count(WishPost.id), wished).filter(
+        WishPost.post_id.in_(post_ids)).group_by(WishPost.post_id) if post_ids else []
+    return {post_id : (count - mine, mine > 0) for post_id, count, mine in rows}
+
+def add_wish_states(posts, student_id):
+    states = wish_states({post['id'] for post in posts}, student_id)
+    for post in posts:
+        post['wish_count'], post['is_wished'] = states.get(post['id'], (0, False))
+    return posts
+
+def serialize_posts(posts, student_id, compact):
+    return add_wish_states(serialize_many(functools.partial(serialize_post, compact=compact), posts), student_id)
+
+def card_view():
+    return request.args.get('view') == 'card'
+
+def serialize_post_card(card):
+    return {
+        'career_ids' : sorted(int(id) for id in card.career_ids.split(',') if id),
+        'category' : {'id' : card.category_id, 'name' : card.category_name},
+        'id' : card.id,
+        'image_url' : card.image_url,
+        'level' : card.level,
+        'name' : card.name,
+        'price' : dump_float(card.price),
+        'publish_date' : dump_datetime(card.publish_date),
+        'status' : card.status,
+        'student' : {'id' : card.student_id, 'name' : card.seller_name, 'seller_rating' : dump_float(card.seller_rating)},
+    }
+
+def serialize_cards(cards, student_id):
+    return add_wish_states(serialize_many(serialize_post_card, cards), student_id)
+
+# Listing filters
+# Shared by the listing endpoints and the ``explain_listings`` check below.
+
+# ``model`` is Post or PostCard, which share these column names.
+
+def filter_active_posts(query, student_id, model=Post):
+    return query.filter(model.student_id==student_id,model.status=='active')
+
+def filter_category_posts(query, category_id, student_id, model=Post):
+    return query.filter(model.category_id==category_id,model.status=='active',model.student_id!=student_id)
+
+def filter_recent_posts(query, student_id, model=Post):
+    return query.filter(model.student_id!=student_id,model.status=='active')
+
+def filter_suggestions(query, student):
+    return query.filter(SuggestionFeed.career_id==student.career_id,SuggestionFeed.level==student.level,SuggestionFeed.student_id!=student.id)
+
+def filter_wishlist(query, student_id):
+    return query.filter(WishPost.student_id == student_id, Post.status == 'active')
+
+def filter_transaction_history(query, student_id):
+    # OR over transaction columns only, so each side can use its own index
+    sold = db.session.query(Post.id).filter(Post.student_id == student_id)
+    return query.filter(or_(Transaction.post_id.in_(sold), Transaction.student_id == student_id))
+
+# Suggestion feed
+
+def suggestion_rows(*conditions):
+    wish_count = select([func.count()]).where(WishPost.post_id == Post.id).as_scalar()
+    return select([careers.c.career_id, Post.level, Post.id, Post.student_id, wish_count]).select_from(
+        careers.join(Post.__table__, careers.c.post_id == Post.id)).where(and_(Post.status == 'active', *conditions))
+
+def refresh_suggestions(*post_ids):
+    # Re-derive the feed rows of these posts from the normalized tables; a post
+    # that is no longer active simply gets no rows back
+    db.session.flush()
+    SuggestionFeed.query.filter(SuggestionFeed.post_id.in_(post_ids)).delete(synchronize_session=False)
+    db.session.execute(SuggestionFeed.__table__.insert().from_select(
+        ['career_id', 'level', 'post_id', 'student_id', 'wish_count'], suggestion_rows(Post.id.in_(post_ids))))
+
+# Post cards
+
+POST_CARD_COLUMNS = ['id', 'name', 'price', 'image_url', 'status', 'level', 'publish_date', 'category_id',
+                     'category_name', 'student_id', 'seller_name', 'seller_rating', 'career_ids', 'post_version', 'seller_version']
+
+def post_card_rows(*conditions):
+    # Same column order as POST_CARD_COLUMNS
+    if db.engine.dialect.name == 'postgresql':
+        career_list = func.string_agg(cast(careers.c.career_id, db.String), ',')
+    else:
+        career_list = func.group_concat(careers.c.career_id, ',')
+    career_ids = select([career_list]).where(careers.c.post_id == Post.id).as_scalar()
+    query = select([Post.id, Post.name, Post.price, Post.image_url, Post.status, Post.level, Post.publish_date,
+                    Post.category_id, Category.name, Post.student_id, Student.name, Student.seller_rating,
+                    func.coalesce(career_ids, ''), Post.version, Student.version]).select_from(Post.__table__.join(Category.__table__).join(Student.__table__))
+    return query.where(and_(*conditions)) if conditions else query
+
+def refresh_post_cards(*post_ids):
+    db.session.flush()
+    PostCard.query.filter(PostCard.id.in_(post_ids)).delete(synchronize_session=False)
+    db.session.execute(PostCard.__table__.insert().from_select(POST_CARD_COLUMNS, post_card_rows(Post.id.in_(post_ids))))
+
+# Bulk writes
+
+def parse_id(value):
+    # Batch items carry ids as JSON numbers or numeric strings, like the single
+    # endpoints accept; anything else is None
+    if isinstance(value, str):
+        value = value.strip()
+        value = int(value) if value.isdecimal() else None
+    elif not isinstance(value, int) or isinstance(value, bool):
+        value = None
+    return value if value != None and is_integer_column(value) else None
+
+def is_integer_column(value):
+    # Fits the Integer columns on every database
+    return -2**31 <= value < 2**31
+
+def is_number(value):
+    # int or float as JSON decodes them, but not bools, NaN or the infinities
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+def batch_post_error(item):
+    # Shape, type and length checks, so a malformed item is reported on its own
+    # instead of failing the INSERT of the whole batch. Missing fields are left
+    # to the per-item checks of publish_batch.
+    if not isinstance(item, dict):
+        return 'Cada publicación debe ser un objeto.'
+    if not isinstance(item.get('category_name', ''), str):
+        return 'Categoría no encontrada.'
+    career_names = item.get('career_names', [])
+    if not isinstance(career_names, list) or not all(isinstance(name, str) for name in career_names):
+        return 'career_names debe ser una lista de nombres de carreras.'
+    for field in ('name', 'description', 'image_url'):
+        length = Post.__table__.c[field].type.length
+        if field in item and not (isinstance(item[field], str) and len(item[field]) <= length):
+            return f'{field} debe ser un texto de hasta {length} caracteres.'
+    if 'price' in item and not is_number(item['price']):
+        return 'price debe ser un número.'
+    level = item.get('level', 0)
+    if not isinstance(level, int) or isinstance(level, bool) or not is_integer_column(level):
+        return 'level debe ser un número entero.'
+    return None
+
+def insert_posts(rows):
+    # Returns the new ids in the order of ``rows``. PostgreSQL and SQLite take
+    # a single multi-row INSERT; other databases get one INSERT per post.
+    if db.engine.dialect.name == 'postgresql':
+        # Reserve the ids up front so a single multi-row INSERT needs no RETURNING
+        ids = [id for id, in db.session.execute("SELECT nextval('post_id_seq') FROM generate_series(1, :count)", {'count' : len(rows)})]
+        db.session.execute(Post.__table__.insert().values([dict(row, id=id) for row, id in zip(rows, ids)]))
+        return ids
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite lets one writer in at a time and gives each new row max(id) + 1,
+        # so the rows of one INSERT get consecutive ids ending at lastrowid
+        last = db.session.execute(Post.__table__.insert().values(rows)).lastrowid
+        return list(range(last - len(rows) + 1, last + 1))
+    posts = [Post(**row) for row in rows]
+    db.session.add_all(posts)
+    db.session.flush()
+    return [post.id for post in posts]
+
+# Cursor pagination
+# Listings are ordered by descending id, so a page is "ids below the cursor".
+# The cursor is the last id of the previous page, base64 encoded to keep it opaque.
+
+class InvalidPage(Exception):
+    pass
+
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(str(id).encode()).decode()
+
+def decode_cursor(cursor, parse=int):
+    try:
+        return parse(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise InvalidPage()
+
+def page_params():
+    params = request.args.to_dict()
+    if request.is_json:
+        params.update(request.get_json())
+    try:
+        limit = int(params.get('limit', app.config['PAGE_SIZE']))
+    except (TypeError, ValueError):
+        raise InvalidPage()
+    if limit < 1:
+        raise InvalidPage()
+    # A JSON body can carry any type; cursors are always the strings we handed out
+    cursor = params.get('cursor') or None
+    if cursor != None and not isinstance(cursor, str):
+        raise InvalidPage()
+    return cursor, min(limit, app.config['MAX_PAGE_SIZE'])
+
+def page_query(query, column):
+    # The page as paginate() fetches it: one extra row tells whether there is a next page
+    cursor, limit = page_params()
+    if cursor != None:
+        query = query.filter(column < decode_cursor(cursor))
+    return query.order_by(desc(column)).limit(limit + 1), limit
+
+def paginate(query, column):
+    query, limit = page_query(query, column)
+    items = query.all()
+    if len(items) > limit:
+        return items[:limit], encode_cursor(items[limit - 1].id)
+    return items, None
+
+def page_response(data, next_cursor):
+    response = jsonify(data)
+    if next_cursor != None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.errorhandler(InvalidPage)
+def invalid_page(e):
+    return jsonify({'error' : 'Parámetros de paginación inválidos.'})
+
+# Streaming
+# ?stream=json sends the whole listing as one chunked JSON array and
+# ?stream=ndjson as one object per line. Ids come from a server-side cursor;
+# each batch is loaded with the listing's eager options, written out and
+# dropped from the session, so memory stays bounded by STREAM_BATCH_SIZE.
+
+STREAM_FORMATS = {'json' : 'application/json', 'ndjson' : 'application/x-ndjson'}
+
+def load_by_ids(query, model, ids):
+    rows = {row.id : row for row in query.filter(model.id.in_(ids))} if ids else {}
+    return [rows[id] for id in ids if id in rows]
+
+def stream_batches(id_query, query, model):
+    size = app.config['STREAM_BATCH_SIZE']
+    ids = []
+    for id, in id_query.execution_options(stream_results=True).yield_per(size):
+        ids.append(id)
+        if len(ids) == size:
+            yield load_by_ids(query, model, ids)
+            ids = []
+    if ids:
+        yield load_by_ids(query, model, ids)
+
+def stream_response(id_query, query, model, serialize_batch):
+    format = request.args['stream']
+    if format not in STREAM_FORMATS:
+        return jsonify({'error' : 'Formato de streaming inválido.'})
+
+    def generate():
+        separator = '' if format == 'ndjson' else '['
+        for items in stream_batches(id_query, query, model):
+            data = serialize_batch(items)
+            db.session.expunge_all()
+            if format == 'ndjson':
+                yield ''.join(json.dumps(item) + '\n' for item in data)
+            else:
+                yield separator + ','.join(json.dumps(item) for item in data)
+                separator = ','
+        if format == 'json':
+            yield '[]' if separator == '[' else ']'
+
+    return app.response_class(stream_with_context(generate()), mimetype=STREAM_FORMATS[format])
+
+# Full-text search
+# Two interchangeable backends rank active posts by relevance over name and
+# description, ignoring case and accents. Both page with a (rank, id) cursor.
+
+def normalize_text(value):
+    value = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(c for c in value if not unicodedata.combining(c))
+
+def tokenize(value):
+    return re.findall(r'\w+', normalize_text(value or ''))
+
+def parse_rank_cursor(value):
+    rank, id = value.split(':')
+    return float(rank), int(id)
+
+def rank_cursor(rank, id):
+    return encode_cursor(f'{rank!r}:{id}')
+
+class PostgresSearchBackend:
+    # Weighted document; must match the expression of the GIN index exactly
+    DOCUMENT = ("setweight(to_tsvector('spanish', usell_unaccent(name)), 'A') || "
+                "setweight(to_tsvector('spanish', usell_unaccent(description)), 'B')")
+
+    def setup(self):
+        # unaccent() is only STABLE, so wrap it to make it usable in an index
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+        db.session.execute("CREATE OR REPLACE FUNCTION usell_unaccent(text) RETURNS text AS "
+                           "$$ SELECT public.unaccent('public.unaccent', $1) $$ "
+                           "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT")
+        db.session.execute(f"CREATE INDEX IF NOT EXISTS ix_post_search ON post "
+                           f"USING gin (({self.DOCUMENT})) WHERE status = 'active'")
+        db.session.commit()
+
+    # The index is maintained by PostgreSQL itself
+    def index(self, post):
+        pass
+
+    def remove(self, post_id):
+        pass
+
+    def search(self, phrase, student_id, cursor, limit):
+        params = {
+            'query' : ' & '.join(f'{token}:*' for token in tokenize(phrase)),
+            'student_id' : student_id,
+            'limit' : limit + 1,
+        }
+        after = ''
+        if cursor != None:
+            params['rank'], params['id'] = decode_cursor(cursor, parse_rank_cursor)
+            after = 'AND (ts_rank(document, q)::float8, id) < (CAST(:rank AS float8), :id)'
+        # ts_rank() returns real; compare at the double precision the cursor keeps
+        # or tied ranks never compare equal to their own cursor
+        rows = db.session.execute(text(f"""
+            SELECT id, ts_rank(document, q)::float8 AS rank
+            FROM (SELECT id, student_id, {self.DOCUMENT} AS document FROM post WHERE status = 'active') p,
+                 to_tsquery('spanish', :query) q
+            WHERE document @@ q AND student_id != :student_id {after}
+            ORDER BY rank DESC, id DESC
+            LIMIT :limit"""), params).fetchall()
+        if len(rows) > limit:
+            return [row.id for row in rows[:limit]], rank_cursor(rows[limit - 1].rank, rows[limit - 1].id)
+        return [row.id for row in rows], None
+
+class MemorySearchBackend:
+    # Inverted index for SQLite and local runs. It is built from the active
+    # posts on first use and kept in sync by the write endpoints of this process
+    # only, so it is meant for a single process: with several workers, writes
+    # made elsewhere are missing from its ranking until a restart.
+    NAME_WEIGHT = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.postings = {}
+        self.tokens = []
+        self.documents = {}
+
+    def setup(self):
+        pass
+
+    def load(self):
+        rows = db.session.query(Post.id, Post.student_id, Post.name, Post.description).filter(Post.status=='active').all()
+        with self.lock:
+            if not self.loaded:
+                for row in rows:
+                    self.add(row.id, row.student_id, row.name, row.description)
+                self.loaded = True
+
+    def add(self, post_id, student_id, name, description):
+        weights = {}
+        for token in tokenize(name):
+            weights[token] = weights.get(token, 0) + self.NAME_WEIGHT
+        for token in tokenize(description):
+            weights[token] = weights.get(token, 0) + 1
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                bisect.insort(self.tokens, token)
+            self.postings[token][post_id] = weight
+        self.documents[post_id] = (student_id, list(weights))
+
+    def discard(self, post_id):
+        if post_id not in self.documents:
+            return
+        for token in self.documents.pop(post_id)[1]:
+            postings = self.postings[token]
+            postings.pop(post_id, None)
+            if not postings:
+                del self.postings[token]
+                self.tokens.pop(bisect.bisect_left(self.tokens, token))
+
+    def index(self, post):
+        with self.lock:
+            if self.loaded:
+                self.discard(post.id)
+                if post.status == 'active':
+                    self.add(post.id, post.student_id, post.name, post.description)
+
+    def remove(self, post_id):
+        with self.lock:
+            if self.loaded:
+                self.discard(post_id)
+
+    def score(self, term):
+        # tf-idf summed over every indexed token the term is a prefix of
+        scores = {}
+        start = bisect.bisect_left(self.tokens, term)
+        for token in self.tokens[start:]:
+            if not token.startswith(term):
+                break
+            postings = self.postings[token]
+            idf = math.log(1 + len(self.documents) / len(postings))
+            for post_id, weight in postings.items():
+                scores[post_id] = scores.get(post_id, 0) + weight * idf
+        return scores
+
+    def search(self, phrase, student_id, cursor, limit):
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            ranks = None
+            for term in tokenize(phrase):
+                scores = self.score(term)
+                if ranks == None:
+                    ranks = scores
+                else:
+                    ranks = {id: rank + scores[id] for id, rank in ranks.items() if id in scores}
+            results = sorted(((round(rank, 6), id) for id, rank in (ranks or {}).items()
+                              if str(self.documents[id][0]) != str(student_id)), reverse=True)
+        if cursor != None:
+            after = decode_cursor(cursor, parse_rank_cursor)
+            results = [result for result in results if result < after]
+        if len(results) > limit:
+            return [id for rank, id in results[:limit]], rank_cursor(*results[limit - 1])
+        return [id for rank, id in results], None
+
+search_backends = {
+    'postgres' : PostgresSearchBackend,
+    'memory' : MemorySearchBackend,
+}
+search_backend = None
+
+def get_search_backend():
+    global search_backend
+    if search_backend == None:
+        name = app.config['SEARCH_BACKEND']
+        if name == None:
+            name = 'postgres' if db.engine.dialect.name == 'postgresql' else 'memory'
+        search_backend = search_backends[name]()
+    return search_backend
+
+def posts_by_ids(ids, wishes=True):
+    # Search results and the suggestion feed can lag behind writes, so drop
+    # anything that was sold or withdrawn in the meantime
+    return load_by_ids(post_query(wishes).filter(Post.status=='active'), Post, ids)
+
+@app.cli.command('init_search')
+def init_search():
+    get_search_backend().setup()
+
+# Response cache
+# Holds the serialized JSON of read-mostly endpoints. Every key embeds a
+# version read on every hit: 'post:<id>:<post version>:<seller version>',
+# 'categories:<etag>' and 'careers:<etag>', so a write is seen by all workers
+# at once and old entries simply age out.
+
+class MemoryCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return None
+            body, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self.lock:
+            self.entries[key] = (body, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class RedisCache:
+    # Shared between workers. LRU eviction is left to the server's
+    # maxmemory-policy (allkeys-lru).
+    def __init__(self, url, ttl, prefix='usell:cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body):
+        self.client.set(self.prefix + key, body, ex=self.ttl)
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_backend(self):
+        if self.backend == None:
+            if app.config['CACHE_BACKEND'] == 'redis':
+                self.backend = RedisCache(app.config['CACHE_REDIS_URL'], app.config['CACHE_TTL'])
+            else:
+                self.backend = MemoryCache(app.config['CACHE_TTL'], app.config['CACHE_MAX_ENTRIES'])
+        return self.backend
+
+    def get(self, key):
+        body = self.get_backend().get(key)
+        if body == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, response):
+        self.get_backend().set(key, response.get_data())
+        return response
+
+cache = ResponseCache()
+
+def cached_response(body):
+    return app.response_class(body, mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+# Version stamps
+# Polled listings answer If-None-Match without loading or serializing the
+# page. A stamp query reads only the ids and version counters of the rows the
+# page would show, and the ETag hashes them with the request. Writes bump the
+# version of each post and student whose serialized form they change, inside
+# their own transaction, so they only lock rows they already write to; rows
+# added or removed change the stamp by themselves. The stamp is read before
+# the data, so a response is never tagged with a version newer than what it contains.
+
+def bump_post_versions(*post_ids):
+    if post_ids:
+        Post.query.filter(Post.id.in_(post_ids)).update({'version' : Post.version + 1}, synchronize_session=False)
+
+def bump_student_version(student_id):
+    Student.query.filter_by(id=student_id).update({'version' : Student.version + 1}, synchronize_session=False)
+
+def page_stamp(query, column):
+    return [tuple(row) for row in page_query(query, column)[0]]
+
+def recent_posts_stamp(student_id):
+    if card_view():
+        # Cards are rewritten by a job some time after the write commits. Their
+        # copy of the versions moves the stamp again once the new card is in
+        # place; the live post version covers the wish states added per request.
+        query = db.session.query(PostCard.id, PostCard.post_version, PostCard.seller_version, Post.version).join(Post, Post.id == PostCard.id)
+        return page_stamp(filter_recent_posts(query, student_id, PostCard), PostCard.id)
+    # Posts embed their seller
+    query = db.session.query(Post.id, Post.version, Student.version).join(Post.student)
+    return page_stamp(filter_recent_posts(query, student_id), Post.id)
+
+def wishlist_stamp(student_id):
+    # Entries embed the post, its seller and the wishing student
+    seller, wisher = aliased(Student), aliased(Student)
+    query = db.session.query(WishPost.id, Post.version, seller.version, wisher.version).join(WishPost.post).join(
+        seller, Post.student).join(wisher, WishPost.student)
+    return page_stamp(filter_wishlist(query, student_id), WishPost.id)
+
+def transaction_history_stamp(student_id):
+    # Transactions embed their statuses, the post, its seller and the purchaser
+    seller, purchaser = aliased(Student), aliased(Student)
+    query = db.session.query(Transaction.id, Transaction.general_status, Transaction.seller_status, Transaction.purchaser_status,
+                             Post.version, seller.version, purchaser.version).join(Transaction.post).join(
+        seller, Post.student).join(purchaser, Transaction.student)
+    return page_stamp(filter_transaction_history(query, student_id), Transaction.id)
+
+def categories_stamp():
+    # Categories are only ever added
+    return tuple(db.session.query(func.count(Category.id), func.max(Category.id)).one())
+
+def careers_stamp():
+    # Careers and posts are only ever added, and edit_post bumps the version of
+    # a post whose careers it changes. Students can also be deleted and
+    # registered again under the same id, so their careers are summed in too.
+    careers = db.session.query(func.count(Career.id), func.max(Career.id)).one()
+    posts = db.session.query(func.count(Post.id), func.max(Post.id), func.sum(Post.version)).one()
+    students = db.session.query(func.count(Student.id), func.max(Student.id), func.sum(Student.version), func.sum(Student.career_id)).one()
+    return tuple(careers) + tuple(posts) + tuple(students)
+
+def resource_etag(stamp):
+    return hashlib.sha1(f'{stamp!r};{request.full_path};'.encode() + request.get_data()).hexdigest()
+
+def versioned(stamp):
+    # ``stamp`` takes the view's arguments; g.etag lets the view key its own caches on it
+    def decorator(view):
+        @functools.wraps(view)
+        def conditional_view(*args, **kwargs):
+            g.etag = resource_etag(stamp(*args, **kwargs))
+            if g.etag in request.if_none_match:
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+            response.set_etag(g.etag)
+            return response
+        return conditional_view
+    return decorator
+
+# Reference data
+# Careers and categories are tiny and nearly static, so every process keeps
+# them in memory, detached from any session, and resolves names without a
+# query. /create_carreers and /create_categories reload this process; other
+# processes notice the change through a periodic count/max(id) check.
+
+class ReferenceRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.careers = None
+        self.categories = None
+        self.version = None
+        self.checked = 0
+
+    def current_version(self):
+        return db.session.query(
+            select([func.count(Career.id)]).as_scalar(),
+            select([func.max(Career.id)]).as_scalar(),
+            select([func.count(Category.id)]).as_scalar(),
+            select([func.max(Category.id)]).as_scalar()).one()
+
+    def load(self):
+        version = self.current_version()
+        careers = {}
+        for career in Career.query.order_by(Career.id):
+            careers.setdefault(career.career_name, career)
+        categories = {}
+        for category in Category.query.order_by(Category.id):
+            categories.setdefault(category.name, category)
+        for instance in list(careers.values()) + list(categories.values()):
+            db.session.expunge(instance)
+        self.careers, self.categories, self.version = careers, categories, version
+        self.checked = time.monotonic()
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.careers == None:
+                self.load()
+            elif time.monotonic() - self.checked > app.config['REFERENCE_CHECK_SECONDS']:
+                self.checked = time.monotonic()
+                if self.current_version() != self.version:
+                    self.load()
+
+    def reload(self):
+        with self.lock:
+            self.careers = None
+
+    def attach(self, instance):
+        # Copy the cached instance into the current session without a SELECT
+        return db.session.merge(instance, load=False) if instance != None else None
+
+    def career(self, name):
+        self.ensure_loaded()
+        return self.attach(self.careers.get(name))
+
+    def category(self, name):
+        self.ensure_loaded()
+        return self.attach(self.categories.get(name))
+
+    def career_id(self, name):
+        self.ensure_loaded()
+        career = self.careers.get(name)
+        return career.id if career != None else None
+
+    def category_id(self, name):
+        self.ensure_loaded()
+        category = self.categories.get(name)
+        return category.id if category != None else None
+
+references = ReferenceRegistry()
+
+# Request metrics
+# Per-process latency, SQL and payload histograms per endpoint, rendered in
+# Prometheus text format by /metrics. Each gunicorn worker reports its own.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    HISTOGRAMS = (
+        ('usell_request_duration_seconds', 'Request latency.', LATENCY_BUCKETS),
+        ('usell_request_sql_statements', 'SQL statements issued per request.', STATEMENT_BUCKETS),
+        ('usell_request_sql_seconds', 'Time spent in SQL per request.', LATENCY_BUCKETS),
+        ('usell_request_serialization_seconds', 'Time spent serializing response data per request.', LATENCY_BUCKETS),
+        ('usell_response_size_bytes', 'Response body size.', SIZE_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {name : {} for name, help, buckets in self.HISTOGRAMS}
+        self.requests = {}
+
+    def observe(self, endpoint, method, status, values):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for name, help, buckets in self.HISTOGRAMS:
+                if values.get(name) != None:
+                    self.histograms[name].setdefault(endpoint, Histogram(buckets)).observe(values[name])
+
+    def render(self):
+        lines = ['# HELP usell_requests_total Requests served.', '# TYPE usell_requests_total counter']
+        with self.lock:
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'usell_requests_total{{endpoint="{label(endpoint)}",method="{method}",status="{status}"}} {count}')
+            for name, help, buckets in self.HISTOGRAMS:
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+                for endpoint, histogram in sorted(self.histograms[name].items()):
+                    endpoint = label(endpoint)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+        lines += [
+            '# HELP usell_cache_hits_total Response cache hits.', '# TYPE usell_cache_hits_total counter',
+            f'usell_cache_hits_total {cache.hits}',
+            '# HELP usell_cache_misses_total Response cache misses.', '# TYPE usell_cache_misses_total counter',
+            f'usell_cache_misses_total {cache.misses}',
+            '# HELP usell_jobs_processed_total Background jobs handled by this process.', '# TYPE usell_jobs_processed_total counter',
+            f'usell_jobs_processed_total {jobs.processed}',
+            '# HELP usell_jobs_errors_total Background job attempts that raised.', '# TYPE usell_jobs_errors_total counter',
+            f'usell_jobs_errors_total {jobs.errors}',
+            '# HELP usell_coalesced_requests_total Requests served from a concurrent identical request.', '# TYPE usell_coalesced_requests_total counter',
+            f'usell_coalesced_requests_total {single_flight.shared}',
+            '# HELP usell_rate_limited_total Requests rejected by the rate limiter.', '# TYPE usell_rate_limited_total counter',
+            f'usell_rate_limited_total {rate_limiter.limited}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def record_serialization(seconds):
+    if has_request_context():
+        g.serialize_time = g.get('serialize_time', 0) + seconds
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        context.usell_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and hasattr(context, 'usell_start'):
+        elapsed = time.perf_counter() - context.usell_start
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_time = g.get('sql_time', 0) + elapsed
+        if app.config['SLOW_REQUEST_MS'] != None:
+            g.setdefault('sql_statements', []).append((elapsed, statement, parameters))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.url_rule.rule if request.url_rule != None else 'unmatched'
+    metrics.observe(endpoint, request.method, response.status_code, {
+        'usell_request_duration_seconds' : elapsed,
+        'usell_request_sql_statements' : g.get('sql_count', 0),
+        'usell_request_sql_seconds' : g.get('sql_time', 0),
+        'usell_request_serialization_seconds' : g.get('serialize_time'),
+        'usell_response_size_bytes' : response.content_length,
+    })
+    threshold = app.config['SLOW_REQUEST_MS']
+    if threshold != None and elapsed * 1000 >= threshold:
+        body = request.get_json(silent=True)
+        phrase = f" phrase={body['phrase']!r}" if isinstance(body, dict) and 'phrase' in body else ''
+        statements = ''.join(f'\n    [{seconds * 1000:.1f} ms] {statement} {parameters!r}'
+                             for seconds, statement, parameters in g.get('sql_statements', []))
+        app.logger.warning(f'Slow request {request.method} {request.full_path}{phrase}: {elapsed * 1000:.1f} ms, '
+                           f"{g.get('sql_count', 0)} SQL statements{statements}")
+    return response
+
+# Request coalescing
+# Concurrent identical GETs on a @coalesced route wait for the first one and
+# reuse its response instead of repeating its queries and serialization.
+# Only requests in the same process meet; the response cache covers the rest.
+
+class InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, function):
+        # Returns (body, status, headers) from function() or from the call already running
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.calls[key] = InFlight()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error != None:
+                raise call.error
+            return call.response
+        try:
+            call.response = function()
+            return call.response
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+single_flight = SingleFlight()
+
+def coalesced(view):
+    @functools.wraps(view)
+    def coalesced_view(*args, **kwargs):
+        if not app.config['COALESCE_REQUESTS'] or request.method != 'GET':
+            return view(*args, **kwargs)
+
+        def respond():
+            response = app.make_response(view(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers)
+
+        body, status, headers = single_flight.do(request.full_path, respond)
+        return app.response_class(body, status=status, headers=headers)
+    return coalesced_view
+
+# Rate limiting
+# A token bucket per client address: RATE_LIMIT_PER_SECOND tokens refill
+# continuously up to RATE_LIMIT_BURST and every request takes one. Clients
+# without a token get a 429 with Retry-After. See client_address for how the
+# address is found behind proxies.
+
+class MemoryRateLimiter:
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key):
+        # Returns 0 when allowed, otherwise the seconds until a token is available
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+class RedisRateLimiter:
+    # The refill and the take run in one script, so workers cannot race on a bucket
+    SCRIPT = '''
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    '''
+
+    def __init__(self, url, rate, burst, prefix='usell:ratelimit:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+
+    def take(self, key):
+        return float(self.script(keys=[self.prefix + key], args=[self.rate, self.burst, time.time()]))
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = None
+        self.limited = 0
+
+    def get_backend(self):
+        if self.backend == None:
+            rate, burst = app.config['RATE_LIMIT_PER_SECOND'], app.config['RATE_LIMIT_BURST']
+            if app.config['RATE_LIMIT_BACKEND'] == 'redis':
+                self.backend = RedisRateLimiter(app.config['RATE_LIMIT_REDIS_URL'], rate, burst)
+            else:
+                self.backend = MemoryRateLimiter(rate, burst)
+        return self.backend
+
+    def take(self, key):
+        wait = self.get_backend().take(key)
+        if wait > 0:
+            self.limited += 1
+        return wait
+
+rate_limiter = RateLimiter()
+
+def client_address():
+    # Every proxy appends the address it got the request from to X-Forwarded-For,
+    # so with N trusted proxies the client is the Nth entry from the end, as with
+    # werkzeug's ProxyFix(x_for=N). Entries before it come from the client and
+    # can say anything.
+    proxies = app.config['RATE_LIMIT_TRUSTED_PROXIES']
+    forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+    if proxies > 0 and len(forwarded) >= proxies and forwarded[-proxies]:
+        return forwarded[-proxies]
+    return request.remote_addr or 'unknown'
+
+@app.before_request
+def limit_request_rate():
+    if app.config['RATE_LIMIT_PER_SECOND'] == None or request.endpoint == 'get_metrics':
+        return None
+    wait = rate_limiter.take(client_address())
+    if wait > 0:
+        response = jsonify({'error' : 'Demasiadas solicitudes. Intenta nuevamente en unos segundos.'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(wait))
+        return response
+
+# Background jobs
+# Side effects of writes that may lag behind the response. Endpoints enqueue
+# them before committing and each process runs them on a small thread pool.
+# Workers claim a job with a conditional UPDATE, so a job runs once at a time
+# across processes; the handler's writes and the job's deletion commit
+# together. Failures are retried with exponential backoff, and jobs whose
+# worker died are reclaimed after JOB_TIMEOUT_SECONDS: delivery is at least
+# once, so handlers must be idempotent.
+
+class JobQueue:
+    def __init__(self):
+        self.handlers = {}
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.processed = 0
+        self.errors = 0
+
+    def handler(self, kind):
+        def register(function):
+            self.handlers[kind] = function
+            return function
+        return register
+
+    def enqueue(self, kind, **payload):
+        db.session.add(Job(kind=kind, payload=json.dumps(payload)))
+        db.session.info['jobs_enqueued'] = True
+
+    def claim(self):
+        now = datetime.now()
+        stale = now - timedelta(seconds=app.config['JOB_TIMEOUT_SECONDS'])
+        due = or_(and_(Job.status == 'pending', Job.run_at <= now), and_(Job.status == 'running', Job.locked_at < stale))
+        for id, in db.session.query(Job.id).filter(due).order_by(Job.id).limit(10).all():
+            claimed = Job.query.filter(Job.id == id, due).update({
+                'status' : 'running', 'locked_at' : now, 'attempts' : Job.attempts + 1,
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(id)
+        db.session.commit()
+        return None
+
+    def run(self, job):
+        id, kind, payload, attempts, locked_at = job.id, job.kind, job.payload, job.attempts, job.locked_at
+        try:
+            self.handlers[kind](**json.loads(payload))
+            # Left alone if the job was reclaimed meanwhile; the new owner reruns it
+            Job.query.filter_by(id=id, locked_at=locked_at).delete(synchronize_session=False)
+            db.session.commit()
+            self.processed += 1
+        except Exception as e:
+            db.session.rollback()
+            self.errors += 1
+            app.logger.warning(f'Job {id} ({kind}) failed on attempt {attempts}: {e!r}')
+            retry = app.config['JOB_RETRY_SECONDS'] * 2 ** (attempts - 1)
+            Job.query.filter_by(id=id, locked_at=locked_at).update({
+                'status' : 'failed' if attempts >= app.config['JOB_MAX_ATTEMPTS'] else 'pending',
+                'run_at' : datetime.now() + timedelta(seconds=retry),
+                'locked_at' : None,
+                'last_error' : f'{type(e).__name__}: {e}',
+            }, synchronize_session=False)
+            db.session.commit()
+
+    def run_pending(self):
+        # Runs every due job in the calling thread and returns how many it ran
+        count = 0
+        job = self.claim()
+        while job != None:
+            self.run(job)
+            count += 1
+            job = self.claim()
+        return count
+
+    def work(self):
+        with app.app_context():
+            while True:
+                try:
+                    ran = self.run_pending()
+                except exc.SQLAlchemyError:
+                    app.logger.exception('Job queue error')
+                    ran = 0
+                finally:
+                    db.session.remove()
+                if ran == 0:
+                    self.wakeup.wait(app.config['JOB_POLL_SECONDS'])
+                    self.wakeup.clear()
+
+    def start(self):
+        # Called per process on its first request, so no thread crosses a fork
+        with self.lock:
+            while len(self.threads) < app.config['JOB_WORKERS']:
+                thread = threading.Thread(target=self.work, name=f'job-worker-{len(self.threads)}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+jobs = JobQueue()
+
+@event.listens_for(db.session, 'after_commit')
+def wake_job_workers(session):
+    if session.info.pop('jobs_enqueued', False):
+        jobs.wakeup.set()
+
+@app.before_first_request
+def start_job_workers():
+    jobs.start()
+
+@jobs.handler('refresh_suggestions')
+def refresh_suggestions_job(post_ids):
+    refresh_suggestions(*post_ids)
+
+@jobs.handler('refresh_post_cards')
+def refresh_post_cards_job(post_ids=(), student_id=None):
+    # Cards embed their seller, so a seller change refreshes all of their posts
+    if student_id != None:
+        post_ids = [*post_ids, *[id for id, in db.session.query(Post.id).filter_by(student_id=student_id)]]
+    refresh_post_cards(*post_ids)
+
+@app.cli.command('run_jobs')
+@click.option('--watch', is_flag=True, help='Keep polling instead of exiting once the queue is drained.')
+def run_jobs(watch):
+    if watch:
+        jobs.work()
+    print(f'Trabajos ejecutados: {jobs.run_pending()}')
+
+# Migrations
+
+@app.cli.command('migrate')
+def migrate():
+    # create_all only adds missing tables, so add columns and indexes declared since
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                table_name = db.engine.dialect.identifier_preparer.format_table(table)
+                db.engine.execute(f'ALTER TABLE {table_name} ADD COLUMN {CreateColumn(column).compile(db.engine)}')
+                print(f'Columna creada: {table.name}.{column.name}')
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                print(f'Índice creado: {index.name}')
+
+@app.cli.command('backfill_ratings')
+def backfill_ratings():
+    # Rebuild the aggregates from the transaction history in one UPDATE. Each
+    # stored rating is the mean over the counted transactions, so sum = mean * count.
+    seller_count = select([func.count()]).select_from(Transaction.__table__.join(Post.__table__)).where(
+        (Post.student_id == Student.id) & (Transaction.purchaser_status == 'finished')).as_scalar()
+    purchaser_count = select([func.count()]).select_from(Transaction.__table__).where(
+        (Transaction.student_id == Student.id) & (Transaction.seller_status == 'finished')).as_scalar()
+    result = db.session.execute(Student.__table__.update().values(
+        seller_rating_count=seller_count,
+        seller_rating_sum=func.coalesce(Student.seller_rating, 0) * seller_count,
+        purchaser_rating_count=purchaser_count,
+        purchaser_rating_sum=func.coalesce(Student.purchaser_rating, 0) * purchaser_count,
+    ))
+    db.session.commit()
+    print(f'Estudiantes actualizados: {result.rowcount}')
+
+@app.cli.command('rebuild_suggestions')
+def rebuild_suggestions():
+    SuggestionFeed.query.delete()
+    db.session.execute(SuggestionFeed.__table__.insert().from_select(
+        ['career_id', 'level', 'post_id', 'student_id', 'wish_count'], suggestion_rows()))
+    db.session.commit()
+    print(f'Sugerencias: {SuggestionFeed.query.count()}')
+
+@app.cli.command('rebuild_post_cards')
+def rebuild_post_cards():
+    PostCard.query.delete()
+    db.session.execute(PostCard.__table__.insert().from_select(POST_CARD_COLUMNS, post_card_rows()))
+    db.session.commit()
+    print(f'Tarjetas: {PostCard.query.count()}')
+
+@app.cli.command('check_post_cards')
+def check_post_cards():
+    # Compares every card with the row the normalized tables give for it
+    def normalize(row):
+        row = dict(zip(POST_CARD_COLUMNS, row))
+        row['career_ids'] = sorted(int(id) for id in row['career_ids'].split(',') if id)
+        # Writes that leave the card as it is, like wishes, move the versions without a rebuild
+        del row['post_version'], row['seller_version']
+        return row
+    expected = {row[0] : normalize(row) for row in db.session.execute(post_card_rows())}
+    actual = {row[0] : normalize(row) for row in db.session.execute(select([PostCard.__table__.c[name] for name in POST_CARD_COLUMNS]))}
+    missing = sorted(expected.keys() - actual.keys())
+    extra = sorted(actual.keys() - expected.keys())
+    different = sorted(id for id in expected.keys() & actual.keys() if expected[id] != actual[id])
+    print(f'Tarjetas: {len(actual)}, faltantes: {len(missing)}, sobrantes: {len(extra)}, distintas: {len(different)}')
+    for id in different[:10]:
+        changed = [name for name in expected[id] if expected[id][name] != actual[id][name]]
+        print(f'    {id}: ' + ', '.join(f'{name} {actual[id][name]!r} != {expected[id][name]!r}' for name in changed))
+    if missing[:10] or extra[:10]:
+        print(f'    faltantes {missing[:10]} sobrantes {extra[:10]}')
+    if missing or extra or different:
+        sys.exit(1)
+
+@app.cli.command('explain_listings')
+def explain_listings():
+    student = Student(id=0, level=1, career_id=0)
+    listings = {
+        'active_posts' : (filter_active_posts(Post.query, 0), Post.id),
+        'all_posts' : (Post.query, Post.id),
+        'all_posts_by_category' : (filter_category_posts(Post.query, 0, 0), Post.id),
+        'recent_posts' : (filter_recent_posts(Post.query, 0), Post.id),
+        'sugested_posts' : (filter_suggestions(SuggestionFeed.query, student), SuggestionFeed.post_id),
+        'wishlist' : (filter_wishlist(WishPost.query.join(Post), 0), WishPost.id),
+        'transaction_history' : (filter_transaction_history(Transaction.query.join(Post), 0), Transaction.id),
+        'active_posts?view=card' : (filter_active_posts(PostCard.query, 0, PostCard), PostCard.id),
+        'all_posts?view=card' : (PostCard.query, PostCard.id),
+        'all_posts_by_category?view=card' : (filter_category_posts(PostCard.query, 0, 0, PostCard), PostCard.id),
+        'recent_posts?view=card' : (filter_recent_posts(PostCard.query, 0, PostCard), PostCard.id),
+    }
+    postgres = db.engine.dialect.name == 'postgresql'
+    if postgres:
+        # Tiny tables are always cheaper to scan; ask whether an index is usable at all
+        db.session.execute('SET enable_seqscan = off')
+    failed = False
+    for name, (query, column) in listings.items():
+        # Plan a page after a cursor, as paginate() runs it
+        query = query.filter(column < 2**31).order_by(desc(column)).limit(app.config['PAGE_SIZE'] + 1)
+        sql = query.statement.compile(db.engine, compile_kwargs={'literal_binds' : True})
+        plan = db.session.execute(('EXPLAIN ' if postgres else 'EXPLAIN QUERY PLAN ') + str(sql)).fetchall()
+        plan = [row[0] if postgres else row[-1] for row in plan]
+        if postgres:
+            scans = [line for line in plan if 'Seq Scan' in line]
+        else:
+            scans = [line for line in plan if re.match(r'SCAN \w+$', line.strip())]
+        failed = failed or bool(scans)
+        print(f"{'SEQ SCAN' if scans else 'OK'} {name}")
+        for line in plan:
+            print(f'    {line}')
+    db.session.rollback()
+    if failed:
+        sys.exit(1)
+
 @app.route('/')
 def index():
     return jsonify({'message' : 'profe ponganos 20'})
 
 @app.route('/student/<id>')
+@read_only
 def get_student(id):
-    student = Student.query.filter_by(id=id).first()
+    student = student_query().filter_by(id=id).first()
     if student == None:
         return jsonify({'error' : 'Usuario no encontrado.'})
     else:
-        return jsonify(student_schema.dump(student))
+        return jsonify(serialize_one(serialize_student, student))
 
 @app.route('/active_posts/<student_id>')
+@read_only
 def get_active_posts(student_id):
-    posts = Post.query.filter_by(student_id=student_id,status='active').order_by(desc(Post.id)).all()
-    return jsonify(posts_schema.dump(posts))
+    if card_view():
+        cards = filter_active_posts(PostCard.query, student_id, PostCard).order_by(desc(PostCard.id)).all()
+        return jsonify(serialize_cards(cards, student_id))
+    compact = compact_listing()
+    posts = filter_active_posts(post_query(not compact), student_id).order_by(desc(Post.id)).all()
+    return jsonify(serialize_posts(posts, student_id, compact))
 
 @app.route('/delete_student/<id>')
 def delte_student(id):
@@ -192,76 +1753,141 @@ def delte_student(id):
         return jsonify({'message' : 'Usuario eliminado con éxito.'})
 
 @app.route('/all_careers')
+@versioned(careers_stamp)
+@coalesced
 def get_all_careers():
-    all_careers = Career.query.all()
+    key = f'careers:{g.etag}'
+    body = cache.get(key)
+    if body != None:
+        return cached_response(body)
+    all_careers = Career.query.options(*career_options()).all()
     if all_careers == None:
         return jsonify({'error' : 'No hay carreras registradas.'})
     else:
-        return jsonify({'career' : careers_schema.dump(all_careers)})
+        return cache.set(key, jsonify({'career' : serialize_many(serialize_career_members, all_careers)}))
 
 @app.route('/all_categories')
+@versioned(categories_stamp)
+@coalesced
 def get_all_categories():
+    # Keyed on the ETag so no process serves an old list under a new tag
+    key = f'categories:{g.etag}'
+    body = cache.get(key)
+    if body != None:
+        return cached_response(body)
     all_categories = Category.query.all()
-    return jsonify(categories_schema.dump(all_categories))
+    return cache.set(key, jsonify(serialize_many(serialize_category, all_categories)))
 
 @app.route('/all_students')
+@read_only
 def get_all_students():
-    all_students = Student.query.all()
+    if 'stream' in request.args:
+        return stream_response(db.session.query(Student.id).order_by(Student.id), student_query(), Student,
+                               lambda students: serialize_many(serialize_student, students))
+    all_students = student_query().all()
     if all_students == None:
         return jsonify({'error' : 'No hay estudiantes registrados.'})
     else:
-        return jsonify(students_schema.dump(all_students))
+        return jsonify(serialize_many(serialize_student, all_students))
 
 @app.route('/single_post/<id>')
+@coalesced
 def get_sinlge_post(id):
-    post = Post.query.filter_by(id=id,status='active').first()
+    # One primary key lookup per hit re-checks the status and picks the
+    # entry for the current post and seller versions
+    versions = db.session.query(Post.version, Student.version).join(Post.student).filter(Post.id==id,Post.status=='active').first()
+    if versions == None:
+        return jsonify({'error' : 'La publicación a la que quieres acceder no está disponible.'})
+    key = 'post:{}:{}:{}'.format(id, *versions)
+    body = cache.get(key)
+    if body != None:
+        return cached_response(body)
+    post = post_query().filter_by(id=id,status='active').first()
     if post == None:
         return jsonify({'error' : 'La publicación a la que quieres acceder no está disponible.'})
     else:
-        return jsonify(post_schema.dump(post))
+        return cache.set(key, jsonify(serialize_one(serialize_post, post)))
 
 @app.route('/all_posts')
+@read_only
 def get_all_posts():
-    all_posts = Post.query.all()
+    if card_view():
+        cards, next_cursor = paginate(PostCard.query, PostCard.id)
+        return page_response({'posts' : serialize_cards(cards, None), 'next_cursor' : next_cursor}, next_cursor)
+    compact = compact_listing()
+    if 'stream' in request.args:
+        return stream_response(db.session.query(Post.id).order_by(desc(Post.id)), post_query(not compact), Post,
+                               lambda posts: serialize_posts(posts, None, compact))
+    all_posts, next_cursor = paginate(post_query(not compact), Post.id)
     if all_posts == None:
         return jsonify({'error' : 'No hay publicaciones registrados.'})
     else:
-        return jsonify({'posts' : posts_schema.dump(all_posts)})
+        return page_response({'posts' : serialize_posts(all_posts, None, compact), 'next_cursor' : next_cursor}, next_cursor)
 
 @app.route('/all_posts_by_category/<category_id>/<student_id>')
+@read_only
 def get_all_posts_by_category(category_id,student_id):
     category = Category.query.filter_by(id=category_id).first()
     if category == None:
         return jsonify({'error' : 'La categoría no existe.'})
-    posts = Post.query.filter(Post.category==category,Post.status=='active',Post.student_id!=student_id).order_by(desc(Post.id))
-    return jsonify(posts_schema.dump(posts))
+    if card_view():
+        cards, next_cursor = paginate(filter_category_posts(PostCard.query, category.id, student_id, PostCard), PostCard.id)
+        return page_response(serialize_cards(cards, student_id), next_cursor)
+    compact = compact_listing()
+    if 'stream' in request.args:
+        ids = filter_category_posts(db.session.query(Post.id), category.id, student_id).order_by(desc(Post.id))
+        return stream_response(ids, post_query(not compact), Post, lambda posts: serialize_posts(posts, student_id, compact))
+    posts, next_cursor = paginate(filter_category_posts(post_query(not compact), category.id, student_id), Post.id)
+    return page_response(serialize_posts(posts, student_id, compact), next_cursor)
     
 @app.route('/recent_posts/<student_id>')
+@read_only
+@versioned(recent_posts_stamp)
 def get_recent_posts(student_id):
-    recent_posts = Post.query.filter(Post.student_id!=student_id,Post.status=='active').order_by(desc(Post.id)).limit(50)
+    if card_view():
+        cards, next_cursor = paginate(filter_recent_posts(PostCard.query, student_id, PostCard), PostCard.id)
+        return page_response(serialize_cards(cards, student_id), next_cursor)
+    compact = compact_listing()
+    recent_posts, next_cursor = paginate(filter_recent_posts(post_query(not compact), student_id), Post.id)
     if recent_posts == None:
         return jsonify({'error' : 'No hay publicaciones registrados.'})
     else:
-        return jsonify(posts_schema.dump(recent_posts))
+        return page_response(serialize_posts(recent_posts, student_id, compact), next_cursor)
 
 @app.route('/sugested_posts/<student_id>')
+@read_only
 def sugested_posts(student_id):
-    student = Student.query.filter_by(id=student_id).first()
-    career_id = student.career.id
-    sugested_posts = Post.query.filter(Post.student_id!=student_id,Post.status=='active',Post.level==student.level,Post.careers.any(id=career_id)).order_by(desc(Post.id)).limit(20)
-    return jsonify(posts_schema.dump(sugested_posts))
+    student = db.session.query(Student.id, Student.career_id, Student.level).filter_by(id=student_id).first()
+    if student == None:
+        return jsonify({'error' : 'Estudiante no encontrado'})
+    feed = filter_suggestions(db.session.query(SuggestionFeed.post_id), student)
+    # ?rank=popular orders by wishlist popularity instead of recency
+    if request.args.get('rank') == 'popular':
+        feed = feed.order_by(desc(SuggestionFeed.wish_count), desc(SuggestionFeed.post_id))
+    else:
+        feed = feed.order_by(desc(SuggestionFeed.post_id))
+    compact = compact_listing()
+    sugested_posts = posts_by_ids([id for id, in feed.limit(20)], not compact)
+    return jsonify(serialize_posts(sugested_posts, student.id, compact))
 
 @app.route('/search_posts', methods=['POST'])
+@read_only
 def search_posts():
     phrase = request.json['phrase']
     student_id = request.json['student_id']
-    posts = Post.query.filter(Post.status=='active',Post.student_id!=student_id,Post.name.ilike(f'%{phrase}%')).order_by(desc(Post.id))
-    return jsonify(posts_schema.dump(posts))
+    compact = compact_listing()
+    if not tokenize(phrase):
+        posts, next_cursor = paginate(post_query(not compact).filter(Post.status=='active',Post.student_id!=student_id), Post.id)
+    else:
+        cursor, limit = page_params()
+        ids, next_cursor = get_search_backend().search(phrase, student_id, cursor, limit)
+        posts = posts_by_ids(ids, not compact)
+    return page_response(serialize_posts(posts, student_id, compact), next_cursor)
 
 @app.route('/register', methods=['POST'])
 def register():
     career_name = request.json['career_name']
-    career = Career.query.filter_by(career_name=career_name).first()
+    career = references.career(career_name)
 
     if career == None:
         return jsonify({'error' : 'Carrera no encontrada.'}) 
@@ -272,12 +1898,10 @@ def register():
             name = request.json['name']
             level = request.json['level']
             phone_number = request.json['phone_number']
-            career_name = request.json['career_name']
             if 'profile_image_url' not in request.get_json():
                 profile_image_url = None
             else:
                 profile_image_url = request.json['profile_image_url']
-            career = Career.query.filter_by(career_name=career_name).first()
             student = Student(id=id,email=email,name=name,level=level,phone_number=phone_number,career=career, profile_image_url=profile_image_url)
             db.session.add(student)
             db.session.commit()
@@ -294,7 +1918,7 @@ def edit_student(id):
         return jsonify({'error' : 'Usuario no encontrado.'})
     else:
         career_name = request.json['career_name']
-        career = Career.query.filter_by(career_name=career_name).first()
+        career = references.career(career_name)
 
         if career == None:
             return jsonify({'error' : 'Carrera no encontrada.'})
@@ -311,6 +1935,8 @@ def edit_student(id):
             student.career = career
             student.level = level
             student.profile_image_url = profile_image_url
+            jobs.enqueue('refresh_post_cards', student_id=student.id)
+            bump_student_version(student.id)
             db.session.commit()
             return jsonify({'message' : 'Información actualizada satisfactoriamente.'})
         
@@ -318,7 +1944,7 @@ def edit_student(id):
 @app.route('/publish', methods=['POST'])
 def publish():   
     category_name = request.json['category_name']
-    category = Category.query.filter_by(name=category_name).first()
+    category = references.category(category_name)
     if category == None:
         return jsonify({'error' : 'Categoría no encontrada.'}) 
     
@@ -330,7 +1956,7 @@ def publish():
     career_names = request.json['career_names']
     careers = []
     for career_name in career_names:
-        career = Career.query.filter_by(career_name=career_name).first()
+        career = references.career(career_name)
         if career == None:
             return jsonify({'error' : 'Carrera no encontrada.'})
         else:
@@ -346,13 +1972,86 @@ def publish():
         post = Post(name=name,price=price,description=description,image_url=image_url,level=level,category=category,student=student)
         post.careers.extend(careers)
         db.session.add(post)
+        db.session.flush()
+        jobs.enqueue('refresh_suggestions', post_ids=[post.id])
+        jobs.enqueue('refresh_post_cards', post_ids=[post.id])
         db.session.commit()
+        get_search_backend().index(post)
         return jsonify({'message' : 'Publicación registrada satisfactoriamente.'})
     except exc.IntegrityError as e:
         return jsonify({'error' : 'Error de integridad.'}) 
     except Exception as e:
         return jsonify({'error' : f'Error al realizar la publicación. {e}'})
 
+@app.route('/publish_batch', methods=['POST'])
+def publish_batch():
+    items = request.json['posts']
+    if not isinstance(items, list):
+        return jsonify({'error' : 'posts debe ser una lista de publicaciones.'})
+    errors = [batch_post_error(item) for item in items]
+    valid = [item for item, error in zip(items, errors) if error == None]
+    category_names = {item.get('category_name') for item in valid}
+    categories = {name : references.category_id(name) for name in category_names}
+    student_ids = {parse_id(item.get('student_id')) for item in valid} - {None}
+    students = {id for id, in db.session.query(Student.id).filter(Student.id.in_(student_ids))}
+    career_names = {name for item in valid for name in item.get('career_names', [])}
+    career_ids = {name : references.career_id(name) for name in career_names}
+
+    results = []
+    rows = []
+    post_careers = []
+    for index, item in enumerate(items):
+        if errors[index] != None:
+            results.append({'index' : index, 'error' : errors[index]})
+            continue
+        try:
+            if categories[item['category_name']] == None:
+                results.append({'index' : index, 'error' : 'Categoría no encontrada.'})
+            elif parse_id(item['student_id']) not in students:
+                results.append({'index' : index, 'error' : 'Estudiante no encontrado'})
+            elif any(career_ids[name] == None for name in item['career_names']):
+                results.append({'index' : index, 'error' : 'Carrera no encontrada.'})
+            else:
+                rows.append({
+                    'name' : item['name'],
+                    'price' : item['price'],
+                    'description' : item['description'],
+                    'image_url' : item['image_url'],
+                    'level' : item['level'],
+                    'status' : 'active',
+                    'category_id' : categories[item['category_name']],
+                    'student_id' : parse_id(item['student_id']),
+                })
+                post_careers.append({career_ids[name] for name in item['career_names']})
+                results.append({'index' : index})
+        except KeyError as e:
+            results.append({'index' : index, 'error' : f'Error al realizar la publicación. Falta el campo {e}'})
+
+    if rows:
+        try:
+            ids = insert_posts(rows)
+            links = [{'career_id' : career_id, 'post_id' : id} for id, career_set in zip(ids, post_careers) for career_id in career_set]
+            if links:
+                db.session.execute(careers.insert().values(links))
+            jobs.enqueue('refresh_suggestions', post_ids=ids)
+            jobs.enqueue('refresh_post_cards', post_ids=ids)
+            db.session.commit()
+        except exc.IntegrityError as e:
+            db.session.rollback()
+            return jsonify({'error' : 'Error de integridad.'})
+        except exc.StatementError as e:
+            # Without the statement and its parameters, which hold the whole batch
+            db.session.rollback()
+            return jsonify({'error' : f'Error al realizar la publicación. {e.orig}'})
+        for row, id in zip(rows, ids):
+            get_search_backend().index(Post(id=id, **row))
+        inserted = iter(ids)
+        for result in results:
+            if 'error' not in result:
+                result['id'] = next(inserted)
+                result['message'] = 'Publicación registrada satisfactoriamente.'
+    return jsonify({'results' : results})
+
 @app.route('/edit_post', methods=['PUT'])
 def edit_post():
     post_id = request.json['post_id']
@@ -361,14 +2060,14 @@ def edit_post():
         return jsonify({'error' : 'La publicación a la que quieres acceder no está disponible.'}) 
 
     category_name = request.json['category_name']
-    category = Category.query.filter_by(name=category_name).first()
+    category = references.category(category_name)
     if category == None:
         return jsonify({'error' : 'Categoría no encontrada.'})
 
     career_names = request.json['career_names']
     careers = []
     for career_name in career_names:
-        career = Career.query.filter_by(career_name=career_name).first()
+        career = references.career(career_name)
         if career == None:
             return jsonify({'error' : 'Carrera no encontrada.'})
         else:
@@ -387,7 +2086,11 @@ def edit_post():
         post.image_url = image_url
         post.level = level
         post.category = category
+        jobs.enqueue('refresh_suggestions', post_ids=[post.id])
+        jobs.enqueue('refresh_post_cards', post_ids=[post.id])
+        bump_post_versions(post.id)
         db.session.commit()
+        get_search_backend().index(post)
         return jsonify({'message' : 'Publicación actualizada satisfactoriamente.'})
     except exc.IntegrityError as e:
         return jsonify({'error' : 'Error de integridad.'}) 
@@ -401,23 +2104,33 @@ def create_transaction():
     if student == None:
         return jsonify({'error' : 'Estudiante no encontrado'})
     id = request.json['id']
-    post = Post.query.filter_by(id=id,status='active').first()
-    if post == None:
+    # Claim the post with a single conditional UPDATE. The database serializes
+    # concurrent buyers on the row, so only one of them sees a match.
+    claimed = Post.query.filter_by(id=id,status='active').update({'status' : 'inProcess', 'version' : Post.version + 1}, synchronize_session=False)
+    if claimed == 0:
+        db.session.rollback()
         return jsonify({'error' : 'La publicación a la que quieres acceder no está disponible.'})
-    post.status = 'inProcess'
-    transaction = Transaction(post=post,student=student)
+    transaction = Transaction(post_id=id,student_id=student.id)
     db.session.add(transaction)
+    jobs.enqueue('refresh_suggestions', post_ids=[id])
+    jobs.enqueue('refresh_post_cards', post_ids=[id])
     db.session.commit()
+    get_search_backend().remove(int(id))
     return jsonify({'message' : '¡Felicitaciones!&sepEl artículo ha sido comprado con éxito. Ahora debes ponerte en contacto con el vendedor para que puedan acordar el lugar y la fecha de entrega. No olvides que puedes encontrar esta compra en tu historial para consultar los datos del vendedor y poder calificar la compra.'})
 
 @app.route('/transaction_history/<student_id>')
+@read_only
+@versioned(transaction_history_stamp)
 def transaction_history(student_id):
-    transactions = Transaction.query.join(Post).filter(or_(Post.student_id == student_id, Transaction.student_id == student_id)).order_by(desc(Transaction.id)).all()
-    return jsonify(transactions_schema.dump(transactions))
+    compact = compact_listing()
+    transactions, next_cursor = paginate(filter_transaction_history(transaction_query(not compact), student_id), Transaction.id)
+    data = serialize_many(functools.partial(serialize_transaction, compact=compact), transactions)
+    add_wish_states([transaction['post'] for transaction in data], student_id)
+    return page_response(data, next_cursor)
 
 @app.route('/qualify_seller/<transaction_id>', methods=['PUT'])
 def qualify_seller(transaction_id):
-    transaction = Transaction.query.filter_by(id=transaction_id,purchaser_status='pending',general_status='pending').first()
+    transaction = Transaction.query.options(joinedload(Transaction.post)).filter_by(id=transaction_id,purchaser_status='pending',general_status='pending').first()
     if transaction == None:
         return jsonify({'error' : 'La transacción no está disponible para calificar'})
     else:
@@ -431,22 +2144,35 @@ def qualify_seller(transaction_id):
             transaction.general_status = 'cancelled'
             transaction.purchaser_status = 'cancelled'
             transaction.post.status = 'active'
+            jobs.enqueue('refresh_suggestions', post_ids=[transaction.post_id])
+            jobs.enqueue('refresh_post_cards', post_ids=[transaction.post_id])
+            bump_post_versions(transaction.post_id)
             db.session.commit()
+            get_search_backend().index(transaction.post)
             return jsonify({'message' : 'Compra cancelada satisfactoriamente'})
         else:
-            transactions_counter = Transaction.query.join(Post).filter(Post.student_id == transaction.post.student.id, Transaction.purchaser_status == 'finished').count()
-            transaction.purchaser_status = 'finished'
-            if transaction.seller_status == 'finished':
-                transaction.general_status = 'finished'
-            seller_raiting = transaction.post.student.seller_rating # seller.seller_rating
-            seller_raiting = (seller_raiting*transactions_counter + new_raiting) / (transactions_counter + 1)
-            transaction.post.student.seller_rating = seller_raiting
+            # Guarded on the pending status so a concurrent rating can't be counted twice
+            rated = Transaction.query.filter_by(id=transaction.id,purchaser_status='pending',general_status='pending').update({
+                'purchaser_status' : 'finished',
+                'general_status' : case([(Transaction.seller_status == 'finished', 'finished')], else_=Transaction.general_status),
+            }, synchronize_session=False)
+            if rated == 0:
+                db.session.rollback()
+                return jsonify({'error' : 'La transacción no está disponible para calificar'})
+            seller_id = transaction.post.student_id
+            Student.query.filter_by(id=seller_id).update({
+                'seller_rating_sum' : Student.seller_rating_sum + new_raiting,
+                'seller_rating_count' : Student.seller_rating_count + 1,
+                'seller_rating' : (Student.seller_rating_sum + new_raiting) / (Student.seller_rating_count + 1),
+            }, synchronize_session=False)
+            jobs.enqueue('refresh_post_cards', student_id=seller_id)
+            bump_student_version(seller_id)
             db.session.commit()
             return jsonify({'message':'Calificación enviada satisfactoriamente'})
 
 @app.route('/qualify_purchaser/<transaction_id>', methods=['PUT'])
 def qualify_purchaser(transaction_id):
-    transaction = Transaction.query.filter_by(id=transaction_id,seller_status='pending',general_status='pending').first()
+    transaction = Transaction.query.options(joinedload(Transaction.post)).filter_by(id=transaction_id,seller_status='pending',general_status='pending').first()
     if transaction == None:
         return jsonify({'error' : 'La transacción no está disponible para calificar'})
     else:
@@ -460,23 +2186,38 @@ def qualify_purchaser(transaction_id):
             transaction.general_status = 'cancelled'
             transaction.seller_status = 'cancelled'
             transaction.post.status = 'active'
+            jobs.enqueue('refresh_suggestions', post_ids=[transaction.post_id])
+            jobs.enqueue('refresh_post_cards', post_ids=[transaction.post_id])
+            bump_post_versions(transaction.post_id)
             db.session.commit()
+            get_search_backend().index(transaction.post)
             return jsonify({'message' : 'Venta cancelada satisfactoriamente'})
         else:
-            transactions_counter = Transaction.query.join(Post).filter(Transaction.student_id == transaction.student.id, Transaction.seller_status == 'finished').count()
-            transaction.seller_status = 'finished'
-            if transaction.purchaser_status == 'finished':
-                transaction.general_status = 'finished'
-            purchaser_raiting = transaction.student.purchaser_rating # seller.seller_rating
-            purchaser_raiting = (purchaser_raiting*transactions_counter + new_raiting) / (transactions_counter + 1)
-            transaction.student.purchaser_rating = purchaser_raiting
+            # Guarded on the pending status so a concurrent rating can't be counted twice
+            rated = Transaction.query.filter_by(id=transaction.id,seller_status='pending',general_status='pending').update({
+                'seller_status' : 'finished',
+                'general_status' : case([(Transaction.purchaser_status == 'finished', 'finished')], else_=Transaction.general_status),
+            }, synchronize_session=False)
+            if rated == 0:
+                db.session.rollback()
+                return jsonify({'error' : 'La transacción no está disponible para calificar'})
+            purchaser_id = transaction.student_id
+            Student.query.filter_by(id=purchaser_id).update({
+                'purchaser_rating_sum' : Student.purchaser_rating_sum + new_raiting,
+                'purchaser_rating_count' : Student.purchaser_rating_count + 1,
+                'purchaser_rating' : (Student.purchaser_rating_sum + new_raiting) / (Student.purchaser_rating_count + 1),
+            }, synchronize_session=False)
+            bump_student_version(purchaser_id)
             db.session.commit()
             return jsonify({'message':'Calificación enviada satisfactoriamente'})
 
 @app.route('/transaction/<transaction_id>')
+@read_only
 def get_transaction(transaction_id):    
-    transaction = Transaction.query.filter_by(id=transaction_id).first()
-    return jsonify(transaction_schema.dump(transaction))
+    transaction = transaction_query().filter(Transaction.id == transaction_id).first()
+    if transaction == None:
+        return jsonify({})
+    return jsonify(serialize_one(serialize_transaction, transaction))
 
 @app.route('/add_to_wishlist/<student_id>', methods=['POST'])
 def add_to_wishlist(student_id):
@@ -489,28 +2230,84 @@ def add_to_wishlist(student_id):
     if post == None:
         return jsonify({'error' : 'La publicación no está disponible'})
     
-    if WishPost.query.filter_by(post=post,student_id=student_id).count() != 0:
-        WishPost.query.filter_by(post=post,student_id=student_id).delete()
+    if WishPost.query.filter_by(post=post,student_id=student_id).delete() != 0:
+        jobs.enqueue('refresh_suggestions', post_ids=[post.id])
+        bump_post_versions(post.id)
         db.session.commit()
         return jsonify({'message' : 'La publicación se eliminó de su lista de deseados'})
         
     wishPost = WishPost(post=post,student=student)
     db.session.add(wishPost)
+    jobs.enqueue('refresh_suggestions', post_ids=[post.id])
+    bump_post_versions(post.id)
     db.session.commit()
     return jsonify({'message':'La publicación se agregó a su lista de deseados'})
 
+@app.route('/wishlist_batch/<student_id>', methods=['POST'])
+def wishlist_batch(student_id):
+    student = db.session.query(Student.id).filter_by(id=student_id).first()
+    if student == None:
+        return jsonify({'error' : 'Estudiante no encontrado'})
+
+    requested = request.json['postIds']
+    if not isinstance(requested, list):
+        return jsonify({'error' : 'postIds debe ser una lista.'})
+    post_ids = [parse_id(value) for value in requested]
+    ids = set(post_ids) - {None}
+    active = {id for id, in db.session.query(Post.id).filter(Post.id.in_(ids),Post.status=='active')}
+    wished = {id for id, in db.session.query(WishPost.post_id).filter(WishPost.student_id==student.id,WishPost.post_id.in_(ids))}
+
+    # Apply the toggles in order, then write only the net change
+    results = []
+    state = {id : id in wished for id in active}
+    for index, (value, post_id) in enumerate(zip(requested, post_ids)):
+        if post_id not in active:
+            results.append({'index' : index, 'postId' : value, 'error' : 'La publicación no está disponible'})
+            continue
+        state[post_id] = not state[post_id]
+        results.append({'index' : index, 'postId' : value, 'message' : 'La publicación se agregó a su lista de deseados' if state[post_id] else 'La publicación se eliminó de su lista de deseados'})
+    removed = [id for id, wish in state.items() if not wish and id in wished]
+    added = [id for id, wish in state.items() if wish and id not in wished]
+
+    if removed:
+        WishPost.query.filter(WishPost.student_id==student.id,WishPost.post_id.in_(removed)).delete(synchronize_session=False)
+    if added:
+        db.session.execute(WishPost.__table__.insert().values([{'post_id' : id, 'student_id' : student.id} for id in added]))
+    if removed or added:
+        jobs.enqueue('refresh_suggestions', post_ids=[*removed, *added])
+        bump_post_versions(*removed, *added)
+    db.session.commit()
+    return jsonify({'results' : results})
+
 @app.route('/wishlist/<student_id>')
+@read_only
+@versioned(wishlist_stamp)
 def get_wishlist(student_id):
-    wishlist = WishPost.query.join(Post).filter(WishPost.student_id == student_id, Post.status == 'active').order_by(desc(WishPost.id)).all()
-    return jsonify(wish_posts_schema.dump(wishlist))
+    compact = compact_listing()
+    wishlist, next_cursor = paginate(filter_wishlist(wish_post_query(not compact), student_id), WishPost.id)
+    data = serialize_many(functools.partial(serialize_wish_post, compact=compact), wishlist)
+    add_wish_states([wish_post['post'] for wish_post in data], student_id)
+    return page_response(data, next_cursor)
 
 @app.route('/remove_wishpost/<student_id>', methods=['DELETE'])
 def remove_wishpost(student_id):
     wishpost_id = request.json['wishpost_id']
+    post_id = db.session.query(WishPost.post_id).filter_by(id=wishpost_id,student_id=student_id).scalar()
     wishpost = WishPost.query.filter_by(id=wishpost_id,student_id=student_id).delete()
+    if post_id != None:
+        jobs.enqueue('refresh_suggestions', post_ids=[post_id])
+        bump_post_versions(post_id)
     db.session.commit()
     return jsonify({'message':'La publicación se eliminó de su lista de deseados'})
 
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify({'backend' : app.config['CACHE_BACKEND'], 'hits' : cache.hits, 'misses' : cache.misses})
+
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/create_carreers')
 def create_careers():
     car1 = Career(career_name='Administración')
@@ -527,6 +2324,7 @@ def create_careers():
     car12 = Career(career_name='Psicología') 
     db.session.add_all([car1,car2,car3,car4,car5,car6,car7,car8,car9,car10,car11,car12])
     db.session.commit()
+    references.reload()
     return jsonify({'message' : 'carreras creadas'})
 
 @app.route('/create_categories')
@@ -536,6 +2334,7 @@ def crate_categories():
     cat3 = Category(name='Ropa',description='En esta categoría podrás ropa, como batas.',image_url='https://firebasestorage.googleapis.com/v0/b/u-sell-app.appspot.com/o/categoryImages%2FRopa.png?alt=media&token=6bbe08da-961c-4583-b383-614010156c15')
     db.session.add_all([cat1,cat2,cat3])
     db.session.commit()
+    references.reload()
     return jsonify({'message' : 'categorias creadas'})
 
 
@@ -0,0 +1,152 @@
+"""Check that cached responses stay consistent across server processes.
+
+Starts two servers on the same throwaway SQLite database, as two gunicorn
+workers would run, warms the /single_post and /all_careers caches of both,
+then makes each kind of write through the first server and reads the
+response back from the second. Any stale read fails the run with exit
+status 1:
+
+    python benchmarks/cache_consistency.py
+    python benchmarks/cache_consistency.py --cache-backend redis --redis-url redis://localhost:6379/0
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def serve(port):
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from backend import app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietHandler).serve_forever()
+
+
+class Server:
+    def __init__(self, port, env):
+        self.port = port
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port)], env=env)
+        started = time.perf_counter()
+        while True:
+            try:
+                self.request('GET', '/')
+                return
+            except OSError:
+                if self.process.poll() != None or time.perf_counter() - started > 30:
+                    raise SystemExit(f'server on port {port} did not start')
+                time.sleep(0.05)
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            connection.request(method, path, json.dumps(body) if body != None else None, {'Content-Type' : 'application/json'})
+            response = connection.getresponse()
+            return json.loads(response.read())
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def seed(writer):
+    writer.request('GET', '/create_carreers')
+    writer.request('GET', '/create_categories')
+    for id in (1, 2):
+        writer.request('POST', '/register', {'id' : id, 'email' : f'student{id}@usell.pe', 'name' : f'Estudiante {id}',
+                                             'level' : 1, 'phone_number' : '999999999', 'career_name' : 'Derecho'})
+    writer.request('POST', '/publish', post_body('Libro original'))
+
+
+def post_body(name):
+    return {'category_name' : 'Libros', 'student_id' : 1, 'career_names' : ['Derecho'], 'name' : name, 'price' : 20,
+            'description' : 'Libro en buen estado.', 'image_url' : 'https://example.com/post.png', 'level' : 1}
+
+
+def members(data, career_name):
+    for career in data.get('career', []):
+        if career['career_name'] == career_name:
+            return sorted(career['post']), sorted(career['student'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--cache-backend', default='memory', choices=['memory', 'redis'])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    parser.add_argument('--port', type=int, default=8775, help='the second server listens on the next port')
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve)
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'cache_consistency.sqlite3'),
+               JOB_WORKERS='0', CACHE_BACKEND=args.cache_backend, CACHE_REDIS_URL=args.redis_url)
+    subprocess.run([sys.executable, '-c', 'from backend import db; db.create_all()'], cwd=ROOT, env=env, check=True)
+    if args.cache_backend == 'redis':
+        import redis
+        redis.Redis.from_url(args.redis_url).flushdb()
+
+    writer, reader = Server(args.port, env), Server(args.port + 1, env)
+    try:
+        seed(writer)
+        post, careers = '/single_post/1', '/all_careers'
+        checks = [
+            ('edit_post', post, lambda: writer.request('PUT', '/edit_post', dict(post_body('Libro editado'), post_id=1)),
+             lambda data: data.get('name') == 'Libro editado'),
+            ('edit_student', post, lambda: writer.request('PUT', '/edit_student/1', {'career_name' : 'Derecho', 'name' : 'Vendedor renombrado', 'level' : 1, 'phone_number' : '999999999'}),
+             lambda data: data.get('student', {}).get('name') == 'Vendedor renombrado'),
+            ('add_to_wishlist', post, lambda: writer.request('POST', '/add_to_wishlist/2', {'postId' : 1}),
+             lambda data: [wish['student'] for wish in data.get('wishPost', [])] == [2]),
+            ('create_transaction', post, lambda: writer.request('POST', '/create_transaction', {'student_id' : 2, 'id' : 1}),
+             lambda data: 'error' in data),
+            ('qualify_seller (cancel)', post, lambda: writer.request('PUT', '/qualify_seller/1', {}),
+             lambda data: data.get('status') == 'active'),
+            ('register', careers, lambda: writer.request('POST', '/register', {'id' : 3, 'email' : 'student3@usell.pe', 'name' : 'Estudiante 3', 'level' : 1,
+                                                                               'phone_number' : '999999999', 'career_name' : 'Economía'}),
+             lambda data: members(data, 'Economía') == ([], [3])),
+            ('publish', careers, lambda: writer.request('POST', '/publish', dict(post_body('Libro nuevo'), career_names=['Economía'])),
+             lambda data: members(data, 'Economía') == ([2], [3])),
+            ('publish_batch', careers, lambda: writer.request('POST', '/publish_batch', {'posts' : [dict(post_body('Libro en lote'), career_names=['Economía'])]}),
+             lambda data: members(data, 'Economía') == ([2, 3], [3])),
+            ('edit_post (careers)', careers, lambda: writer.request('PUT', '/edit_post', dict(post_body('Libro editado'), post_id=1, career_names=['Economía'])),
+             lambda data: members(data, 'Economía') == ([1, 2, 3], [3]) and members(data, 'Derecho') == ([], [1, 2])),
+            ('edit_student (career)', careers, lambda: writer.request('PUT', '/edit_student/2', {'career_name' : 'Economía', 'name' : 'Estudiante 2', 'level' : 1, 'phone_number' : '999999999'}),
+             lambda data: members(data, 'Economía') == ([1, 2, 3], [2, 3])),
+            ('delete_student', careers, lambda: writer.request('GET', '/delete_student/3'),
+             lambda data: members(data, 'Economía') == ([1, 2, 3], [2])),
+        ]
+        failed = []
+        for name, path, write, expected in checks:
+            # Warm both caches with the current state
+            writer.request('GET', path)
+            reader.request('GET', path)
+            write()
+            data = reader.request('GET', path)
+            ok = expected(data)
+            if not ok:
+                failed.append(name)
+            print(f"{'OK' if ok else 'STALE':<6} {name}")
+        stats = reader.request('GET', '/cache_stats')
+        print(f"second server cache: {stats['backend']}, {stats['hits']} hits, {stats['misses']} misses")
+    finally:
+        writer.stop()
+        reader.stop()
+    if failed:
+        print(f"Stale reads after: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
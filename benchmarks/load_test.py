@@ -0,0 +1,438 @@
+"""Seed a database with realistic volumes and load-test every route.
+
+Drives each route of backend.py first through the Flask test client and then
+over HTTP with concurrent clients, and reports p50/p99 latency, throughput and
+SQL statements per request. Results can be saved as a JSON baseline and diffed
+against a later run:
+
+    python benchmarks/load_test.py --scale 0.01 --output baseline.json
+    python benchmarks/load_test.py --scale 0.01 --skip-seed --compare baseline.json
+
+--target sends the HTTP phase to an already running server (e.g. gunicorn)
+instead of an in-process one; SQL counts are then not available. The seed-only
+routes /create_carreers and /create_categories are run once while seeding.
+"""
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+VOLUMES = {
+    'students' : 50000,
+    'posts' : 500000,
+    'wishlists' : 2000000,
+    'transactions' : 1000000,
+}
+
+WORDS = ['libro', 'cálculo', 'física', 'química', 'economía', 'contabilidad', 'marketing', 'derecho', 'bata',
+         'laboratorio', 'calculadora', 'regla', 'compás', 'mochila', 'cuaderno', 'lápiz', 'diccionario', 'inglés',
+         'estadística', 'finanzas', 'maqueta', 'arquitectura', 'psicología', 'usado', 'nuevo', 'edición']
+
+# (general_status, seller_status, purchaser_status) and how often they occur
+TRANSACTION_STATES = [
+    (('finished', 'finished', 'finished'), 0.6),
+    (('cancelled', 'cancelled', 'pending'), 0.15),
+    (('cancelled', 'pending', 'cancelled'), 0.15),
+    (('pending', 'pending', 'pending'), 0.1),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'usell_load.sqlite3')))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the default volumes')
+    for name, count in VOLUMES.items():
+        parser.add_argument(f'--{name}', type=int, help=f'rows to seed (default {count} * scale)')
+    parser.add_argument('--skip-seed', action='store_true', help='reuse an already seeded database')
+    parser.add_argument('--requests', type=int, default=50, help='requests per route and phase')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per route before timing')
+    parser.add_argument('--concurrency', type=int, default=8, help='HTTP clients per route')
+    parser.add_argument('--routes', nargs='+', help='only run these route names')
+    parser.add_argument('--target', help='base URL of a running server for the HTTP phase')
+    parser.add_argument('--no-http', action='store_true', help='skip the HTTP phase')
+    parser.add_argument('--no-test-client', action='store_true', help='skip the test client phase')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='diff against a saved JSON baseline')
+    parser.add_argument('--threshold', type=float, default=20.0, help='p99 regression tolerance in percent')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for name, count in VOLUMES.items():
+        if getattr(args, name) == None:
+            setattr(args, name, max(1, int(count * args.scale)))
+    return args
+
+
+def chunks(rows, size=10000):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sentence(count):
+    return ' '.join(random.sample(WORDS, count))
+
+
+def seed(backend, args):
+    db = backend.db
+    print(f"Seeding {args.students} students, {args.posts} posts, {args.wishlists} wishlist and {args.transactions} transaction rows")
+    started = time.perf_counter()
+    db.drop_all()
+    db.create_all()
+    client = backend.app.test_client()
+    client.get('/create_carreers')
+    client.get('/create_categories')
+    career_ids = [id for id, in db.session.query(backend.Career.id)]
+    category_ids = [id for id, in db.session.query(backend.Category.id)]
+    now = datetime.now()
+
+    def insert(table, rows):
+        for chunk in chunks(rows):
+            db.session.execute(table.insert(), chunk)
+        db.session.commit()
+
+    insert(backend.Student.__table__, ({
+        'id' : id, 'email' : f'estudiante{id}@usell.pe', 'name' : f'Estudiante {id}', 'level' : random.randint(1, 10),
+        'phone_number' : f'9{id:08d}'[:9], 'career_id' : random.choice(career_ids),
+        'seller_rating' : round(random.uniform(1, 5), 2), 'purchaser_rating' : round(random.uniform(1, 5), 2),
+    } for id in range(1, args.students + 1)))
+    insert(backend.Post.__table__, ({
+        'id' : id, 'name' : sentence(2).capitalize(), 'price' : round(random.uniform(5, 400), 1),
+        'description' : sentence(6).capitalize() + '.', 'image_url' : f'https://example.com/posts/{id}.png',
+        'status' : 'active', 'level' : random.randint(1, 10), 'publish_date' : now - timedelta(minutes=args.posts - id),
+        'category_id' : random.choice(category_ids), 'student_id' : random.randint(1, args.students),
+    } for id in range(1, args.posts + 1)))
+    insert(backend.careers, ({'post_id' : id, 'career_id' : career_id}
+                             for id in range(1, args.posts + 1)
+                             for career_id in random.sample(career_ids, random.randint(1, 3))))
+    # Popularity is skewed towards a minority of the posts
+    insert(backend.WishPost.__table__, ({
+        'post_id' : int(args.posts * random.random() ** 3) + 1, 'student_id' : random.randint(1, args.students),
+        'added_date' : now,
+    } for _ in range(args.wishlists)))
+    states = [state for state, weight in TRANSACTION_STATES]
+    weights = [weight for state, weight in TRANSACTION_STATES]
+    pending = set()
+
+    def transactions():
+        for id in range(1, args.transactions + 1):
+            general, seller, purchaser = random.choices(states, weights)[0]
+            post_id = random.randint(1, args.posts)
+            if general == 'pending':
+                pending.add(post_id)
+            yield {'id' : id, 'date' : now, 'general_status' : general, 'seller_status' : seller,
+                   'purchaser_status' : purchaser, 'post_id' : post_id, 'student_id' : random.randint(1, args.students)}
+
+    insert(backend.Transaction.__table__, transactions())
+    for chunk in chunks(sorted(pending), 900):
+        backend.Post.query.filter(backend.Post.id.in_(chunk)).update({'status' : 'inProcess'}, synchronize_session=False)
+    db.session.commit()
+    runner = backend.app.test_cli_runner()
+    for command in ('backfill_ratings', 'rebuild_suggestions', 'rebuild_post_cards'):
+        result = runner.invoke(args=[command])
+        if result.exit_code != 0:
+            raise SystemExit(f'{command} failed: {result.output}')
+    print(f'Seeded in {time.perf_counter() - started:.1f} s')
+
+
+class Fixture:
+    # Random but valid ids for building requests; shared by all client threads
+    def __init__(self, backend, args):
+        db = backend.db
+        self.students = args.students
+        self.active_posts = [id for id, in db.session.query(backend.Post.id).filter_by(status='active').limit(100000)]
+        self.pending = [id for id, in db.session.query(backend.Transaction.id).filter_by(general_status='pending').limit(100000)]
+        self.wish_posts = db.session.query(func.max(backend.WishPost.id)).scalar() or 1
+        self.transactions = args.transactions
+        self.careers = [name for name, in db.session.query(backend.Career.career_name)]
+        self.categories = [name for name, in db.session.query(backend.Category.name)]
+        self.new_students = itertools.count(args.students + 1000000)
+        self.registered = collections.deque()
+        db.session.remove()
+
+    def student(self):
+        return random.randint(1, self.students)
+
+    def post(self):
+        return random.choice(self.active_posts)
+
+    def transaction(self):
+        return random.choice(self.pending) if self.pending else random.randint(1, self.transactions)
+
+    def post_body(self):
+        return {
+            'category_name' : random.choice(self.categories), 'student_id' : self.student(),
+            'career_names' : random.sample(self.careers, 2), 'name' : sentence(2).capitalize(),
+            'price' : round(random.uniform(5, 400), 1), 'description' : sentence(6).capitalize() + '.',
+            'image_url' : 'https://example.com/posts/new.png', 'level' : random.randint(1, 10),
+        }
+
+    def register(self):
+        id = next(self.new_students)
+        self.registered.append(id)
+        return {'id' : id, 'email' : f'nuevo{id}@usell.pe', 'name' : f'Nuevo {id}', 'level' : random.randint(1, 10),
+                'phone_number' : '999999999', 'career_name' : random.choice(self.careers)}
+
+    def registered_student(self):
+        try:
+            return self.registered.popleft()
+        except IndexError:
+            return 0
+
+
+def routes(data):
+    # name -> (method, path factory, JSON body factory)
+    return collections.OrderedDict([
+        ('index', ('GET', lambda: '/', None)),
+        ('student', ('GET', lambda: f'/student/{data.student()}', None)),
+        ('active_posts', ('GET', lambda: f'/active_posts/{data.student()}', None)),
+        ('all_careers', ('GET', lambda: '/all_careers', None)),
+        ('all_categories', ('GET', lambda: '/all_categories', None)),
+        ('all_students', ('GET', lambda: '/all_students', None)),
+        ('single_post', ('GET', lambda: f'/single_post/{data.post()}', None)),
+        ('single_post_hot', ('GET', lambda: f'/single_post/{data.active_posts[0]}', None)),
+        ('all_posts', ('GET', lambda: '/all_posts', None)),
+        ('all_posts_by_category', ('GET', lambda: f'/all_posts_by_category/{random.randint(1, 3)}/{data.student()}', None)),
+        ('recent_posts', ('GET', lambda: f'/recent_posts/{data.student()}', None)),
+        ('recent_posts_cards', ('GET', lambda: f'/recent_posts/{data.student()}?view=card', None)),
+        ('sugested_posts', ('GET', lambda: f'/sugested_posts/{data.student()}', None)),
+        ('search_posts', ('POST', lambda: '/search_posts', lambda: {'phrase' : random.choice(WORDS), 'student_id' : data.student()})),
+        ('transaction_history', ('GET', lambda: f'/transaction_history/{data.student()}', None)),
+        ('transaction', ('GET', lambda: f'/transaction/{random.randint(1, data.transactions)}', None)),
+        ('wishlist', ('GET', lambda: f'/wishlist/{data.student()}', None)),
+        ('cache_stats', ('GET', lambda: '/cache_stats', None)),
+        ('metrics', ('GET', lambda: '/metrics', None)),
+        ('register', ('POST', lambda: '/register', data.register)),
+        ('edit_student', ('PUT', lambda: f'/edit_student/{data.student()}', lambda: dict(data.register(), career_name=random.choice(data.careers)))),
+        ('delete_student', ('GET', lambda: f'/delete_student/{data.registered_student()}', None)),
+        ('publish', ('POST', lambda: '/publish', data.post_body)),
+        ('publish_batch', ('POST', lambda: '/publish_batch', lambda: {'posts' : [data.post_body() for _ in range(20)]})),
+        ('edit_post', ('PUT', lambda: '/edit_post', lambda: dict(data.post_body(), post_id=data.post()))),
+        ('add_to_wishlist', ('POST', lambda: f'/add_to_wishlist/{data.student()}', lambda: {'postId' : data.post()})),
+        ('wishlist_batch', ('POST', lambda: f'/wishlist_batch/{data.student()}', lambda: {'postIds' : [data.post() for _ in range(20)]})),
+        ('remove_wishpost', ('DELETE', lambda: f'/remove_wishpost/{data.student()}', lambda: {'wishpost_id' : random.randint(1, data.wish_posts)})),
+        ('create_transaction', ('POST', lambda: '/create_transaction', lambda: {'student_id' : data.student(), 'id' : data.post()})),
+        ('qualify_seller', ('PUT', lambda: f'/qualify_seller/{data.transaction()}', lambda: {'new_raiting' : random.randint(1, 5)})),
+        ('qualify_purchaser', ('PUT', lambda: f'/qualify_purchaser/{data.transaction()}', lambda: {'new_raiting' : random.randint(1, 5)})),
+    ])
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        # Background jobs run on their own threads and are not part of any request
+        if threading.current_thread().name.startswith('job-worker'):
+            return
+        with self.lock:
+            self.count += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else None
+
+
+def summarize(latencies, statuses, elapsed, statements):
+    # A status of None is a connection failure
+    return {
+        'requests' : len(latencies),
+        'errors' : sum(status == None or status >= 500 for status in statuses),
+        'rate_limited' : statuses.count(429),
+        'p50_ms' : round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms' : round(percentile(latencies, 99) * 1000, 3),
+        'throughput_rps' : round(len(latencies) / elapsed, 1),
+        'queries_per_request' : round(statements / len(latencies), 2) if statements != None else None,
+    }
+
+
+def run_test_client(backend, route, count, counter):
+    if count == 0:
+        return None
+    method, path, body = route
+    client = backend.app.test_client()
+    latencies = []
+    statuses = []
+    before = counter.count
+    started = time.perf_counter()
+    for _ in range(count):
+        url, payload = path(), body() if body else None
+        start = time.perf_counter()
+        response = client.open(url, method=method, json=payload)
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        statuses.append(response.status_code)
+    return summarize(latencies, statuses, time.perf_counter() - started, counter.count - before)
+
+
+def run_http(base_url, route, count, concurrency, counter):
+    method, path, body = route
+    target = urllib.parse.urlsplit(base_url)
+    remaining = iter(range(count))
+    lock = threading.Lock()
+    latencies = []
+    statuses = []
+
+    def client():
+        connection = http.client.HTTPConnection(target.hostname, target.port, timeout=60)
+        while True:
+            with lock:
+                if next(remaining, None) == None:
+                    break
+                url, payload = path(), body() if body else None
+            headers = {'Content-Type' : 'application/json'} if payload != None else {}
+            start = time.perf_counter()
+            try:
+                connection.request(method, url, body=json.dumps(payload) if payload != None else None, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port, timeout=60)
+                status = None
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                statuses.append(status)
+        connection.close()
+
+    before = counter.count if counter else None
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    statements = counter.count - before if counter else None
+    return summarize(latencies, statuses, time.perf_counter() - started, statements)
+
+
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def print_results(phase, results):
+    print(f'\n{phase}')
+    print(f"{'route':<24} {'reqs':>6} {'err':>4} {'429':>5} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8} {'queries':>8}")
+    for name, result in results.items():
+        queries = result['queries_per_request']
+        print(f"{name:<24} {result['requests']:>6} {result['errors']:>4} {result.get('rate_limited', 0):>5} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+              f"{result['throughput_rps']:>8.1f} {queries if queries != None else '-':>8}")
+
+
+def compare(baseline, current, threshold):
+    regressions = 0
+    for phase, results in current['results'].items():
+        previous = baseline['results'].get(phase, {})
+        print(f'\n{phase} vs baseline ({baseline["meta"].get("commit")})')
+        print(f"{'route':<24} {'p50':>9} {'p99':>9} {'req/s':>9} {'queries':>12}")
+        for name, result in results.items():
+            if name not in previous:
+                continue
+            before = previous[name]
+            change = lambda key: (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            queries = f"{before['queries_per_request']}->{result['queries_per_request']}" if result['queries_per_request'] != None else '-'
+            regressed = change('p99_ms') > threshold or (result['queries_per_request'] or 0) > (before['queries_per_request'] or 0)
+            regressions += regressed
+            print(f"{name:<24} {change('p50_ms'):>+8.1f}% {change('p99_ms'):>+8.1f}% {change('throughput_rps'):>+8.1f}% {queries:>12}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    os.environ['DATABASE_URL'] = args.database
+    sys.path.insert(0, ROOT)
+    import backend
+
+    with backend.app.app_context():
+        if not args.skip_seed:
+            seed(backend, args)
+        data = Fixture(backend, args)
+    counter = StatementCounter(backend.db.engine)
+    selected = [(name, route) for name, route in routes(data).items() if not args.routes or name in args.routes]
+
+    results = {}
+    if not args.no_test_client:
+        results['test_client'] = collections.OrderedDict()
+        for name, route in selected:
+            run_test_client(backend, route, args.warmup, counter)
+            results['test_client'][name] = run_test_client(backend, route, args.requests, counter)
+        print_results('Flask test client', results['test_client'])
+
+    if not args.no_http:
+        server = None
+        base_url = args.target
+        if base_url == None:
+            server, base_url = start_server(backend.app)
+        results['http'] = collections.OrderedDict()
+        for name, route in selected:
+            results['http'][name] = run_http(base_url, route, args.requests, args.concurrency, None if args.target else counter)
+        if server != None:
+            server.shutdown()
+        print_results(f'HTTP, {args.concurrency} concurrent clients ({base_url})', results['http'])
+
+    report = {
+        'meta' : {
+            'commit' : git_commit(),
+            'database' : backend.db.engine.dialect.name,
+            'volumes' : {name : getattr(args, name) for name in VOLUMES},
+            'requests' : args.requests,
+            'concurrency' : args.concurrency,
+            'target' : args.target,
+            'python' : sys.version.split()[0],
+            'date' : datetime.now().isoformat(),
+        },
+        'results' : results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f'\nSaved {args.output}')
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), report, args.threshold)
+        if regressions:
+            print(f'\n{regressions} regressions')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
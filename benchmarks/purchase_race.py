@@ -0,0 +1,99 @@
+"""Stress /create_transaction with concurrent buyers of the same post.
+
+Seeds one active post, releases every buyer thread at once against it and
+checks that exactly one purchase succeeded and exactly one transaction row
+was written. Exits with status 1 otherwise:
+
+    python benchmarks/purchase_race.py --buyers 300 --rounds 3
+
+--database points it at another database, e.g. a local PostgreSQL; its
+tables are dropped and recreated.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--database', default='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'purchase_race.sqlite3'))
+parser.add_argument('--buyers', type=int, default=300, help='concurrent buyers per round')
+parser.add_argument('--rounds', type=int, default=3, help='posts raced for, one after another')
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.database
+# The suggestion and card jobs are not part of the race
+os.environ['JOB_WORKERS'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from backend import app, db, Post, Student, Transaction
+
+SUCCESS = '¡Felicitaciones!'
+UNAVAILABLE = 'La publicación a la que quieres acceder no está disponible.'
+
+
+def seed(buyers):
+    db.drop_all()
+    db.create_all()
+    client = app.test_client()
+    client.get('/create_carreers')
+    client.get('/create_categories')
+    # Student 1 sells; everyone else buys
+    for id in range(1, buyers + 2):
+        client.post('/register', json={'id' : id, 'email' : f'student{id}@usell.pe', 'name' : f'Estudiante {id}', 'level' : 1,
+                                       'phone_number' : '999999999', 'career_name' : 'Administración'})
+    db.session.remove()
+
+
+def race(buyers):
+    client = app.test_client()
+    client.post('/publish', json={'category_name' : 'Libros', 'student_id' : 1, 'career_names' : ['Administración'],
+                                  'name' : 'Libro en disputa', 'price' : 50, 'description' : 'Solo hay uno.',
+                                  'image_url' : 'https://example.com/post.png', 'level' : 1})
+    post_id = db.session.query(db.func.max(Post.id)).scalar()
+    db.session.remove()
+
+    start = threading.Barrier(buyers)
+    outcomes = []
+    lock = threading.Lock()
+
+    def buy(student_id):
+        start.wait()
+        response = app.test_client().post('/create_transaction', json={'student_id' : student_id, 'id' : post_id})
+        if response.status_code != 200:
+            outcome = f'HTTP {response.status_code}'
+        else:
+            data = response.get_json()
+            outcome = data.get('message') or data.get('error')
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=buy, args=(id,)) for id in range(2, buyers + 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    successes = sum(outcome.startswith(SUCCESS) for outcome in outcomes)
+    rejected = outcomes.count(UNAVAILABLE)
+    rows = Transaction.query.filter_by(post_id=post_id).count()
+    status = db.session.query(Post.status).filter_by(id=post_id).scalar()
+    db.session.remove()
+    print(f'post {post_id}: {successes} succeeded, {rejected} rejected, {len(outcomes) - successes - rejected} failed otherwise, '
+          f'{rows} transaction rows, status {status}')
+    for outcome in sorted(set(outcomes) - {UNAVAILABLE} - {outcome for outcome in outcomes if outcome.startswith(SUCCESS)}):
+        print(f'    {outcome}')
+    return successes == 1 and rejected == buyers - 1 and rows == 1 and status == 'inProcess'
+
+
+def main():
+    with app.app_context():
+        seed(args.buyers)
+        results = [race(args.buyers) for _ in range(args.rounds)]
+    if not all(results):
+        print('More or less than one buyer won a post')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Check that every listing endpoint runs a fixed number of SQL statements.
+
+Seeds a throwaway SQLite database with N posts, counts the statements each
+listing request issues, reseeds with 10 * N posts and counts again. Any
+listing whose count changed with the row count (an N+1 lazy load) fails
+the run with exit status 1:
+
+    python benchmarks/query_counts.py --posts 40
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import event
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'query_counts.sqlite3')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DATABASE
+# The seed rebuilds the feeds and cards itself, so no job workers are needed
+os.environ['JOB_WORKERS'] = '0'
+os.environ['SEARCH_BACKEND'] = 'memory'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import backend
+from backend import app, db, Career, Category, Post, Student, Transaction, WishPost, careers
+
+STUDENTS = 10
+# The student every per-student listing is requested for
+STUDENT = 1
+
+LISTINGS = [
+    ('active_posts', 'GET', f'/active_posts/{STUDENT}', None),
+    ('all_posts', 'GET', '/all_posts', None),
+    ('all_posts_by_category', 'GET', f'/all_posts_by_category/1/{STUDENT}', None),
+    ('recent_posts', 'GET', f'/recent_posts/{STUDENT}', None),
+    ('sugested_posts', 'GET', f'/sugested_posts/{STUDENT}', None),
+    ('search_posts', 'POST', '/search_posts', {'phrase' : 'libro', 'student_id' : STUDENT}),
+    ('search_posts (empty phrase)', 'POST', '/search_posts', {'phrase' : '', 'student_id' : STUDENT}),
+    ('wishlist', 'GET', f'/wishlist/{STUDENT}', None),
+    ('transaction_history', 'GET', f'/transaction_history/{STUDENT}', None),
+]
+
+
+def seed(posts):
+    random.seed(0)
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    client = app.test_client()
+    client.get('/create_carreers')
+    client.get('/create_categories')
+    career_ids = [id for id, in db.session.query(Career.id)]
+    category_ids = [id for id, in db.session.query(Category.id)]
+    now = datetime.now()
+    db.session.execute(Student.__table__.insert(), [
+        {'id' : id, 'email' : f'student{id}@usell.pe', 'name' : f'Estudiante {id}', 'level' : 1,
+         'phone_number' : '999999999', 'career_id' : career_ids[0], 'seller_rating' : 4.0, 'purchaser_rating' : 4.0}
+        for id in range(1, STUDENTS + 1)])
+    # Every student shares career and level, so the suggestion feed grows with the posts
+    db.session.execute(Post.__table__.insert(), [
+        {'id' : id, 'name' : f'Libro {id}', 'price' : random.randint(5, 300) / 1.0, 'description' : 'Libro en buen estado.',
+         'image_url' : 'https://example.com/post.png', 'status' : 'active', 'level' : 1, 'publish_date' : now,
+         'category_id' : random.choice(category_ids), 'student_id' : id % STUDENTS + 1}
+        for id in range(1, posts + 1)])
+    db.session.execute(careers.insert(), [
+        {'post_id' : id, 'career_id' : career_id}
+        for id in range(1, posts + 1) for career_id in [career_ids[0], *random.sample(career_ids[1:], 2)]])
+    db.session.execute(WishPost.__table__.insert(), [
+        {'post_id' : post_id, 'student_id' : student_id, 'added_date' : now}
+        for post_id in range(1, posts + 1) for student_id in random.sample(range(1, STUDENTS + 1), 3)])
+    # A tenth of the posts are sold, half of them to STUDENT
+    sold = range(1, posts + 1, 10)
+    db.session.execute(Transaction.__table__.insert(), [
+        {'date' : now, 'post_id' : post_id, 'student_id' : STUDENT if index % 2 else random.randint(2, STUDENTS)}
+        for index, post_id in enumerate(sold)])
+    Post.query.filter(Post.id.in_(sold)).update({'status' : 'inProcess'}, synchronize_session=False)
+    db.session.commit()
+    runner = app.test_cli_runner()
+    for command in ('rebuild_suggestions', 'rebuild_post_cards'):
+        result = runner.invoke(args=[command])
+        if result.exit_code != 0:
+            raise SystemExit(f'{command} failed: {result.output}')
+    backend.search_backend = None
+    db.session.remove()
+
+
+def count_statements(limit):
+    counter = {'statements' : 0}
+
+    def increment(*args):
+        counter['statements'] += 1
+
+    client = app.test_client()
+    # The first request loads the reference data and the search index
+    client.get('/all_categories')
+    client.post('/search_posts', json={'phrase' : 'libro', 'student_id' : STUDENT})
+    counts = {}
+    event.listen(db.engine, 'before_cursor_execute', increment)
+    try:
+        for name, method, path, body in LISTINGS:
+            for suffix in ('', '&compact=1', '&view=card'):
+                if suffix == '&view=card' and name not in ('active_posts', 'all_posts', 'all_posts_by_category', 'recent_posts'):
+                    continue
+                counter['statements'] = 0
+                response = client.open(f'{path}?limit={limit}{suffix}', method=method, json=body)
+                data = response.get_json()
+                if response.status_code != 200 or isinstance(data, dict) and 'error' in data:
+                    raise SystemExit(f'{name}{suffix} failed: {response.status_code} {data}')
+                if isinstance(data, dict):
+                    data = data.get('posts', [])
+                counts[name + suffix.replace('&', '?', 1)] = (counter['statements'], len(data))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', increment)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=40, help='posts in the small seed; the large one has ten times as many')
+    args = parser.parse_args()
+    limit = app.config['MAX_PAGE_SIZE']
+
+    with app.app_context():
+        seed(args.posts)
+        small = count_statements(limit)
+        seed(args.posts * 10)
+        large = count_statements(limit)
+
+    print(f"{'':<40} {'rows':^11} {'statements':^11}")
+    print(f"{'listing':<40} {'small':>5} {'large':>5} {'small':>5} {'large':>5}")
+    failed = []
+    for name in small:
+        (small_count, small_rows), (large_count, large_rows) = small[name], large[name]
+        if small_count != large_count:
+            failed.append(name)
+        print(f"{name:<40} {small_rows:>5} {large_rows:>5} {small_count:>5} {large_count:>5}  {'OK' if small_count == large_count else 'FAIL'}")
+    if failed:
+        print(f"Statement counts grow with the rows: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Compare the fast serializers with the Marshmallow schema dumps.
+
+Seeds a throwaway SQLite database, loads the posts the way the listing
+endpoints do and times both serializers over the same objects:
+
+    python benchmarks/serialization.py --posts 1000 10000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from flask import jsonify
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'serialization.sqlite3')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DATABASE
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from backend import app, db, Career, Category, Post, Student, WishPost, careers, post_query, posts_schema, serialize_many, serialize_post
+
+
+def seed(posts, students=200):
+    random.seed(0)
+    db.drop_all()
+    db.create_all()
+    app.test_client().get('/create_carreers')
+    app.test_client().get('/create_categories')
+    career_ids = [id for id, in db.session.query(Career.id)]
+    category_ids = [id for id, in db.session.query(Category.id)]
+    db.session.execute(Student.__table__.insert(), [
+        {'id' : id, 'email' : f'student{id}@usell.pe', 'name' : f'Estudiante {id}', 'level' : random.randint(1, 10),
+         'phone_number' : '999999999', 'career_id' : random.choice(career_ids), 'seller_rating' : 0.0, 'purchaser_rating' : 0.0}
+        for id in range(1, students + 1)])
+    db.session.execute(Post.__table__.insert(), [
+        {'id' : id, 'name' : f'Libro {id}', 'price' : random.randint(5, 300) / 1.0, 'description' : 'Libro en buen estado.',
+         'image_url' : 'https://example.com/post.png', 'status' : 'active', 'level' : random.randint(1, 10),
+         'category_id' : random.choice(category_ids), 'student_id' : random.randint(1, students)}
+        for id in range(1, posts + 1)])
+    db.session.execute(careers.insert(), [
+        {'post_id' : id, 'career_id' : career_id}
+        for id in range(1, posts + 1) for career_id in random.sample(career_ids, 2)])
+    db.session.execute(WishPost.__table__.insert(), [
+        {'post_id' : random.randint(1, posts), 'student_id' : random.randint(1, students)}
+        for _ in range(posts * 2)])
+    db.session.commit()
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'posts':>8} {'schema ms':>10} {'fast ms':>10} {'speedup':>8}  identical")
+    with app.test_request_context():
+        for count in args.posts:
+            seed(count)
+            posts = post_query().all()
+            schema_time, schema_data = best_of(args.repeat, lambda: posts_schema.dump(posts))
+            fast_time, fast_data = best_of(args.repeat, lambda: serialize_many(serialize_post, posts))
+            identical = jsonify(schema_data).get_data() == jsonify(fast_data).get_data()
+            print(f'{count:>8} {schema_time * 1000:>10.1f} {fast_time * 1000:>10.1f} {schema_time / fast_time:>7.1f}x  {identical}')
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Compare gunicorn server profiles: startup time and throughput.
+
+Starts gunicorn once per profile against an already seeded database, times
+how long it takes to answer its first request, then drives it with the HTTP
+phase of load_test.py:
+
+    python benchmarks/load_test.py --scale 0.01 --no-http
+    python benchmarks/server_profiles.py --requests 200 --concurrency 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# name -> (gunicorn arguments, extra environment)
+PROFILES = {
+    'default' : (['backend:app'], {}),
+    'tuned' : (['-c', 'gunicorn.conf.py', 'backend:app'], {}),
+    'tuned-no-preload' : (['-c', 'gunicorn.conf.py', 'backend:app'], {'GUNICORN_PRELOAD' : '0'}),
+}
+
+ROUTES = ['index', 'student', 'single_post', 'all_posts', 'recent_posts', 'sugested_posts', 'search_posts',
+          'wishlist', 'transaction_history', 'add_to_wishlist', 'create_transaction']
+
+
+def wait_until_up(url, process, timeout=60):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() != None:
+            raise SystemExit(f'gunicorn exited with status {process.returncode}')
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return time.perf_counter() - started
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f'{url} did not answer within {timeout} s')
+
+
+def run_profile(name, args, port):
+    arguments, environment = PROFILES[name]
+    env = dict(os.environ, DATABASE_URL=args.database, PORT=str(port), **environment)
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    process = subprocess.Popen(['gunicorn', '--bind', f'127.0.0.1:{port}', *arguments],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        startup = wait_until_up(base_url + '/', process)
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'load_test.py'), '--database', args.database,
+                            '--skip-seed', '--no-test-client', '--target', base_url, '--requests', str(args.requests),
+                            '--concurrency', str(args.concurrency), '--routes', *args.routes, '--output', output.name],
+                           check=True, stdout=subprocess.DEVNULL)
+            results = json.load(output)['results']['http']
+    finally:
+        process.terminate()
+        process.wait()
+    return startup, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'usell_load.sqlite3')))
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--routes', nargs='+', default=ROUTES)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, help='WEB_CONCURRENCY for every profile')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.profiles:
+        startup, results = run_profile(name, args, args.port)
+        report[name] = {'startup_s' : round(startup, 3), 'routes' : results}
+
+    print(f"{'route':<24}" + ''.join(f'{name:>30}' for name in report))
+    print(f"{'':<24}" + ''.join(f"{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}" for name in report))
+    for route in args.routes:
+        row = ''
+        for name in report:
+            result = report[name]['routes'][route]
+            row += f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['throughput_rps']:>10.1f}"
+        print(f'{route:<24}{row}')
+    print(f"{'startup s':<24}" + ''.join(f"{report[name]['startup_s']:>30.2f}" for name in report))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# Production server profile, used by the Procfile:
+#
+#     gunicorn -c gunicorn.conf.py backend:app
+#
+# Every setting can be overridden from the environment. Database pool sizes
+# and the statement timeout are configured in backend.py (DB_* variables);
+# keep workers * (threads or DB_POOL_SIZE + DB_MAX_OVERFLOW) under the
+# database's connection limit.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# 'gthread' serves several requests per process without extra dependencies;
+# 'gevent' also works when gevent (and psycogreen for psycopg2) is installed.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Import backend.py once in the master so models, mappers and schemas are
+# built before forking and shared copy-on-write by the workers.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Recycle workers now and then to bound slow leaks; jitter avoids restarting them all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 500))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def when_ready(server):
+    # Mappers are otherwise configured by the first query in each worker
+    if preload_app:
+        from sqlalchemy.orm import configure_mappers
+        configure_mappers()
+
+
+def post_fork(server, worker):
+    # Sockets opened by the master must not be shared between processes
+    if preload_app:
+        from backend import db
+        db.engine.dispose()